@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.api
+~~~~~~~~~
+
+This module contains a local HTTP server answering price comparisons from the products kept in memory.
+
+The products of every shop are replaced as a whole when the shop is crawled again, so queries are answered while the
+crawls go on. The master shopping list is posted in the body, as csv (the format of the master shopping list file) or
+as a json list of rows:
+
+    curl -X POST --data-binary @data/master_shopping_list.csv http://127.0.0.1:8080/compare
+    curl -X POST --data-binary @data/master_shopping_list.csv -o list.ods 'http://127.0.0.1:8080/compare?format=ods'
+
+GET /shops returns how many products every shop has and when they were crawled.
+
+"""
+
+import os
+import sys
+import csv
+import json
+import tempfile
+import traceback
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from StringIO import StringIO
+
+
+# Content type of every format of the comparison
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'csv': 'text/csv; charset=utf-8',
+    'ods': 'application/vnd.oasis.opendocument.spreadsheet',
+}
+
+
+def find_cheapest(products):
+    """Return the positions of the products (None for the ones not found) with the lowest unitary price"""
+
+    unitary_prices = [product.unitary_price for product in products
+                      if product is not None and product.unitary_price > 0.0]
+    if not unitary_prices:
+        return []
+    return [i for i, product in enumerate(products)
+            if product is not None and product.unitary_price == min(unitary_prices)]
+
+
+def parse_master_product_list(body):
+    """Parse a master shopping list posted as csv or json into a list of (name, product ids per shop)"""
+
+    if body.lstrip().startswith('['):
+        rows = json.loads(body)
+        for row in rows:
+            if not isinstance(row, list):
+                raise ValueError('{0} is not a list'.format(json.dumps(row)))
+            if row and not isinstance(row[0], basestring):
+                raise ValueError('the name of {0} is not a string'.format(json.dumps(row)))
+            if not all(isinstance(value, basestring) or value is None for value in row[1:]):
+                raise ValueError('the product ids of {0} are not strings or null'.format(json.dumps(row)))
+        rows = [[value.encode('utf-8') if isinstance(value, unicode) else value for value in row] for row in rows]
+    else:
+        rows = list(csv.reader(StringIO(body)))
+
+    return [(row[0], tuple(row[1:])) for row in rows if row]
+
+
+class ComparisonServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server keeping the shops whose products are compared.
+
+    crawled has the time when the products of every shop were crawled (None if they never were). export_ods(master
+    product list, shop list, filename) is called to build the spreadsheets.
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, shop_list, crawled, export_ods, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ComparisonRequestHandler)
+        self.export_ods = export_ods
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        # Shops whose products are compared, in the order of the columns of the master shopping list
+        self.shop_list = list(shop_list)
+        self.crawled = list(crawled)
+
+    def update(self, position, shop, crawled):
+        """Replace the shop of the column position, whose products were crawled at time crawled"""
+
+        with self._lock:
+            self.shop_list[position] = shop
+            self.crawled[position] = crawled
+
+    def get_shops(self):
+        """Return the shops and the times when they were crawled"""
+
+        with self._lock:
+            return list(self.shop_list), list(self.crawled)
+
+
+class ComparisonRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handler of the comparison queries"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if urlparse.urlsplit(self.path).path != '/shops':
+            return self.respond(404, json.dumps({'error': 'Not found'}))
+
+        shop_list, crawled = self.server.get_shops()
+        self.respond(200, json.dumps({'shops': [{'name': shop.name,
+                                                 'products': len(shop.product_dict),
+                                                 'crawled': crawled_time,
+                                                 'stale_since': shop.stale_since}
+                                                for shop, crawled_time in zip(shop_list, crawled)]}))
+
+    def do_POST(self):
+        url = urlparse.urlsplit(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if url.path != '/compare':
+            return self.respond(404, json.dumps({'error': 'Not found'}))
+
+        output_format = dict(urlparse.parse_qsl(url.query)).get('format', 'json')
+        if output_format not in CONTENT_TYPES:
+            return self.respond(400, json.dumps({'error': 'Unknown format ' + output_format}))
+
+        try:
+            master_product_list = parse_master_product_list(body)
+        except (ValueError, TypeError, IndexError, csv.Error) as e:
+            return self.respond(400, json.dumps({'error': 'Wrong master shopping list: ' + str(e)}))
+
+        shop_list, _ = self.server.get_shops()
+        for name, product_ids in master_product_list:
+            if len(product_ids) > len(shop_list):
+                return self.respond(400, json.dumps({'error': 'Wrong master shopping list: {0} has {1} product ids, '
+                                                              'but there are {2} shops'.format(name, len(product_ids),
+                                                                                               len(shop_list))}))
+
+        try:
+            if output_format == 'ods':
+                body = self.build_ods(master_product_list, shop_list)
+            elif output_format == 'csv':
+                body = self.build_csv(master_product_list, shop_list)
+            else:
+                body = self.build_json(master_product_list, shop_list)
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            return self.respond(500, json.dumps({'error': 'Error building the comparison: ' + str(e)}))
+        self.respond(200, body, CONTENT_TYPES[output_format])
+
+    def respond(self, status, body, content_type=CONTENT_TYPES['json']):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def compare(self, master_product_list, shop_list):
+        """Iterate over the products of the master shopping list: (name, products per shop, cheapest positions)"""
+
+        for name, product_ids in master_product_list:
+            products = [shop.get_product(product_id) if product_id else None
+                        for shop, product_id in zip(shop_list, product_ids)]
+            yield name, products, find_cheapest(products)
+
+    def build_json(self, master_product_list, shop_list):
+        comparison = []
+        for name, products, cheapest in self.compare(master_product_list, shop_list):
+            comparison.append({'name': name,
+                               'shops': dict((shop.name, product.to_dict() if product is not None else None)
+                                             for shop, product in zip(shop_list, products)),
+                               'cheapest': [shop_list[i].name for i in cheapest]})
+
+        return json.dumps({'shops': [{'name': shop.name, 'stale_since': shop.stale_since} for shop in shop_list],
+                           'products': comparison})
+
+    def build_csv(self, master_product_list, shop_list):
+        output = StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['Product'] + [shop.name + ' ' + column for shop in shop_list
+                                       for column in ('product', 'price', 'unitary price', 'unit')] + ['Cheapest'])
+        for name, products, cheapest in self.compare(master_product_list, shop_list):
+            row = [name]
+            for product in products:
+                if product is not None:
+                    row.extend([product.name, product.price, product.unitary_price, product.unit])
+                else:
+                    row.extend([''] * 4)
+            writer.writerow(row + [';'.join(shop_list[i].name for i in cheapest)])
+        return output.getvalue()
+
+    def build_ods(self, master_product_list, shop_list):
+        fd, filename = tempfile.mkstemp(suffix='.ods')
+        os.close(fd)
+        try:
+            self.server.export_ods(master_product_list, shop_list, filename)
+            with open(filename, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(filename)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.async_backend
+~~~~~~~~~~~~~~~~~~~
+
+This module contains the optional asynchronous crawling backend, based on gevent.
+
+Every crawl runs in a greenlet and every request yields to the event loop while waiting for the network, so a single
+thread can crawl lots of shops or lists at once. The crawlers keep their synchronous code: gevent makes the blocking
+sockets used by requests cooperative. enable() must be called before creating the connection pool shared by the shops,
+so the locks guarding it are cooperative too.
+
+"""
+
+try:
+    import gevent
+    import gevent.lock
+    import gevent.monkey
+    import gevent.pool
+except ImportError:
+    gevent = None
+
+from session import Session
+
+
+def enable():
+    """Make the sockets (and the locks guarding the shared connection pool) cooperative.
+
+    Raise RuntimeError if gevent is not installed.
+
+    """
+
+    if gevent is None:
+        raise RuntimeError('The asynchronous backend requires gevent (pip install gevent)')
+
+    if not gevent.monkey.is_module_patched('socket'):
+        gevent.monkey.patch_socket()
+        gevent.monkey.patch_ssl()
+        gevent.monkey.patch_thread()
+
+
+class AsyncSession(Session):
+    """Session whose requests run in the gevent event loop.
+
+    Requests are still called as in a regular session (the calling greenlet waits for the response, letting the rest
+    of the greenlets run meanwhile), but request_async() can be used to issue requests which do not depend on each
+    other at the same time. The number of requests in flight is bounded by max_requests.
+
+    """
+
+    def __init__(self, base_url=None, max_requests=10):
+        enable()
+        Session.__init__(self, base_url=base_url)
+        self.semaphore = gevent.lock.BoundedSemaphore(max_requests)
+
+    def request(self, method, url, *args, **kwargs):
+        with self.semaphore:
+            return Session.request(self, method, url, *args, **kwargs)
+
+    def spawn(self, func, *args, **kwargs):
+        """Call func in a new greenlet and return it. The result is got with greenlet.get()"""
+
+        return gevent.spawn(func, *args, **kwargs)
+
+    def sleep(self, seconds):
+        """Wait for some seconds, letting the rest of the greenlets run"""
+
+        gevent.sleep(seconds)
+
+    def request_async(self, method, url, *args, **kwargs):
+        """Spawn the request in a new greenlet and return it. The response is got with greenlet.get()"""
+
+        return self.spawn(self.request, method, url, *args, **kwargs)
+
+
+class Pool(object):
+    """Pool of greenlets, with the same map() interface than multiprocessing.pool.ThreadPool"""
+
+    def __init__(self, size):
+        enable()
+        self.pool = gevent.pool.Pool(size)
+
+    def map(self, func, iterable):
+        return self.pool.map(func, iterable)
+
+    def apply_async(self, func, args=()):
+        """Call func in a greenlet of the pool and return an AsyncResult-like object to wait for it"""
+
+        return GreenletResult(self.pool.spawn(func, *args))
+
+    def close(self):
+        pass
+
+    def join(self):
+        self.pool.join()
+
+
+class GreenletResult(object):
+    """Greenlet wrapped with the wait()/ready()/get() interface of multiprocessing.pool.AsyncResult"""
+
+    def __init__(self, greenlet):
+        self.greenlet = greenlet
+
+    def wait(self, timeout=None):
+        self.greenlet.join(timeout)
+
+    def ready(self):
+        return self.greenlet.ready()
+
+    def get(self, timeout=None):
+        return self.greenlet.get(timeout=timeout)
+
+
+def gather_products_async(shop):
+    """Start crawling shop in a new greenlet and return it"""
+
+    enable()
+    shop.session_class = AsyncSession
+    return gevent.spawn(shop.gather_products)
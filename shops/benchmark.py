@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.benchmark
+~~~~~~~~~~~~~~~
+
+This module contains a benchmark suite of the parsers of the shops, run over the pages used in fake mode (the last
+ones captured in the fixture store or, if there are none, data/<Shop>_fake_page.html) and over scaled-up variants of
+them, with the product rows repeated.
+
+For every shop and scale, it times the phases of parse_product_list_page (HTML parse, including the scan for the
+fragment of the page to be parsed, extraction of the fields of the rows and normalisation of the products, the rest of
+the parse), and measures the rows parsed per second and the peak
+memory used by the parse. It times the XPath expressions of the shop too, evaluated both as the compiled XPath objects
+of the class and as strings compiled on every call (as element.xpath() does), and the extraction of the fields of the
+rows, both with one XPath call per row and with an XPath query per field.
+
+The results can be saved as json and later runs compared with them, flagging the regressions beyond a threshold (the
+exit status is 1 if there is any):
+
+    python -m shops.benchmark --scales 1,10 --output benchmark.json
+    python -m shops.benchmark --scales 1,10 --compare benchmark.json --threshold 0.1
+
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import ctypes
+import argparse
+import resource
+
+import lxml.html
+from lxml.etree import XPath
+
+from mercadona import Mercadona
+from hipercor import Hipercor
+from eroski import Eroski
+from extract import RowExtractor
+from fixtures import FixtureStore
+
+
+SHOP_CLASSES = (Mercadona, Hipercor, Eroski)
+
+# Statistics compared with the ones saved by a previous run, and whether higher values are better
+COMPARED_STATS = (('rows_per_second', True), ('html', False), ('extraction', False), ('normalisation', False),
+                  ('peak_memory', False))
+
+
+class PhaseTimer(object):
+    """Timer of the phases of a parse, accumulating the time spent in the functions wrapped for every phase"""
+
+    def __init__(self):
+        self.times = {}
+
+    def wrap(self, phase, func):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.times[phase] = self.times.get(phase, 0.0) + time.time() - start
+        return timed
+
+
+def best_time(func, repeat):
+    """Return the best time of repeat calls of func"""
+
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def peak_memory(func):
+    """Return the memory (in KB) used by func at its peak, over the memory used before calling it.
+
+    func is called in a child process, so the peak is not hidden by the ones reached before. The memory freed before
+    is given back to the system first where the C library allows it (glibc), otherwise func would reuse it unnoticed.
+
+    """
+
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            func()
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write_fd, str(after - before))
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'r') as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    return int(result) if result else None
+
+
+def get_xpaths(shop_class):
+    """Get the compiled XPath expressions of a shop class used to parse the product list page (the ones without
+    variables), by attribute name"""
+
+    return dict((name, getattr(shop_class, name)) for name in dir(shop_class)
+                if isinstance(getattr(shop_class, name), XPath) and '$' not in getattr(shop_class, name).path)
+
+
+def get_row_extractors(shop_class):
+    """Get the row extractors of a shop class, by attribute name"""
+
+    return dict((name, getattr(shop_class, name)) for name in dir(shop_class)
+                if isinstance(getattr(shop_class, name), RowExtractor))
+
+
+def scale_page(shop, page, scale):
+    """Return page with the product rows repeated scale times"""
+
+    if scale == 1:
+        return page
+
+    html_tree = shop.parse_html(page)
+    rows = shop.find_product_rows(html_tree)
+    for _ in range(scale - 1):
+        for row in rows:
+            row.getparent().append(copy.deepcopy(row))
+    return lxml.html.tostring(html_tree.getroottree(), encoding=shop.encoding)
+
+
+def time_phases(shop, page):
+    """Parse page with shop, timing its phases. Return the times by phase"""
+
+    timer = PhaseTimer()
+    shop.find_product_table = timer.wrap('html', shop.find_product_table)
+    shop.parse_html = timer.wrap('html', shop.parse_html)
+    shop.find_product_rows = timer.wrap('extraction', shop.find_product_rows)
+    for name, extractor in get_row_extractors(shop.__class__).items():
+        timed_extractor = copy.copy(extractor)
+        timed_extractor.extract = timer.wrap('extraction', extractor.extract)
+        setattr(shop, name, timed_extractor)
+
+    shop.product_dict = {}
+    try:
+        start = time.time()
+        shop.parse_product_list_page(page)
+        total = time.time() - start
+    finally:
+        # Drop the wrappers, back to the attributes of the class
+        for name in ['find_product_table', 'parse_html', 'find_product_rows']:
+            delattr(shop, name)
+        for name in get_row_extractors(shop.__class__):
+            delattr(shop, name)
+
+    times = {'html': timer.times.get('html', 0.0), 'extraction': timer.times.get('extraction', 0.0), 'total': total}
+    times['normalisation'] = max(total - times['html'] - times['extraction'], 0.0)
+    return times
+
+
+def benchmark_shop(shop, page, repeat):
+    """Return the statistics of the parse of page by shop"""
+
+    phases = min((time_phases(shop, page) for _ in range(repeat)), key=lambda times: times['total'])
+
+    def parse():
+        shop.product_dict = {}
+        shop.parse_product_list_page(page)
+
+    memory = peak_memory(parse)
+
+    html_tree = shop.parse_html(page)
+    rows = shop.find_product_rows(html_tree)
+    xpaths = get_xpaths(shop.__class__)
+    extractors = get_row_extractors(shop.__class__).values()
+    field_xpaths = [XPath(path) for extractor in extractors for path in extractor.paths.values()]
+
+    def evaluate_compiled():
+        for xpath in xpaths.values():
+            if xpath.path.startswith('.'):
+                for row in rows:
+                    xpath(row)
+            else:
+                xpath(html_tree)
+
+    def evaluate_strings():
+        for xpath in xpaths.values():
+            if xpath.path.startswith('.'):
+                for row in rows:
+                    row.xpath(xpath.path)
+            else:
+                html_tree.xpath(xpath.path)
+
+    def extract_one_call():
+        for extractor in extractors:
+            for row in rows:
+                extractor.extract(row)
+
+    def extract_per_field():
+        for xpath in field_xpaths:
+            for row in rows:
+                xpath(row)
+
+    return {'shop': shop.name,
+            'bytes': len(page),
+            'rows': len(rows),
+            'products': len(shop.product_dict),
+            'html': phases['html'],
+            'extraction': phases['extraction'],
+            'normalisation': phases['normalisation'],
+            'parse': phases['total'],
+            'rows_per_second': len(rows) / phases['total'] if phases['total'] else 0.0,
+            'peak_memory': memory,
+            'xpath_strings': best_time(evaluate_strings, repeat),
+            'xpath_compiled': best_time(evaluate_compiled, repeat),
+            'fields_per_field': best_time(extract_per_field, repeat),
+            'fields_one_call': best_time(extract_one_call, repeat)}
+
+
+def find_regressions(results, baseline, threshold):
+    """Compare the results of a run with the ones of a baseline run.
+
+    Return a list of (shop, scale, statistic, baseline value, value) for the statistics which are worse than in the
+    baseline by more than threshold (a fraction of the baseline value).
+
+    """
+
+    baseline_results = dict(((stats['shop'], stats['scale']), stats) for stats in baseline['results'])
+    regressions = []
+    for stats in results:
+        baseline_stats = baseline_results.get((stats['shop'], stats['scale']))
+        if baseline_stats is None:
+            continue
+
+        for name, higher_is_better in COMPARED_STATS:
+            value, baseline_value = stats.get(name), baseline_stats.get(name)
+            if not value or not baseline_value:
+                continue
+            change = (value - baseline_value) / float(baseline_value)
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append((stats['shop'], stats['scale'], name, baseline_value, value))
+    return regressions
+
+
+def print_results(results):
+    print '{0:<10} {1:>5} {2:>6} {3:>9} {4:>11} {5:>14} {6:>9} {7:>10} {8:>12}'.format(
+        'Shop', 'Scale', 'Rows', 'HTML', 'Extraction', 'Normalisation', 'Parse', 'Rows/s', 'Peak memory')
+    for stats in results:
+        print ('{shop:<10} {scale:>5} {rows:>6} {0:>7.2f}ms {1:>9.2f}ms {2:>12.2f}ms {3:>7.2f}ms '
+               '{rows_per_second:>10.0f} {4:>12}').format(
+            stats['html'] * 1000, stats['extraction'] * 1000, stats['normalisation'] * 1000, stats['parse'] * 1000,
+            '{0} KB'.format(stats['peak_memory']) if stats['peak_memory'] is not None else '-', **stats)
+
+    print
+    print '{0:<10} {1:>5} {2:>14} {3:>15} {4:>8} {5:>11} {6:>12} {7:>8}'.format(
+        'Shop', 'Scale', 'XPath strings', 'XPath compiled', 'Speedup', 'Per field', 'One call', 'Speedup')
+    for stats in results:
+        print '{shop:<10} {scale:>5} {0:>12.2f}ms {1:>13.2f}ms {2:>7.2f}x {3:>9.2f}ms {4:>10.2f}ms {5:>7.2f}x'.format(
+            stats['xpath_strings'] * 1000, stats['xpath_compiled'] * 1000,
+            stats['xpath_strings'] / stats['xpath_compiled'], stats['fields_per_field'] * 1000,
+            stats['fields_one_call'] * 1000, stats['fields_per_field'] / stats['fields_one_call'], **stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite of the parsers of the shops')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='times every parse is repeated, the best one is taken (default: %(default)s)')
+    parser.add_argument('--fixture-dir', default='data/fixtures',
+                        help='directory of the fixture store (default: %(default)s)')
+    parser.add_argument('--scales', default='1,10',
+                        help='comma separated times the product rows of every page are repeated (default: %(default)s)')
+    parser.add_argument('--no-fragment', action='store_true',
+                        help='parse the whole pages, instead of only the tables of products')
+    parser.add_argument('--output', metavar='FILENAME', help='save the results as json to FILENAME')
+    parser.add_argument('--compare', metavar='FILENAME',
+                        help='compare the results with the ones saved to FILENAME by a previous run and flag the '
+                             'regressions')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fraction by which a statistic must be worse than in the compared run to be flagged '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    try:
+        scales = [int(scale) for scale in args.scales.split(',')]
+    except ValueError:
+        parser.error('Wrong scales: ' + args.scales)
+    if any(scale < 1 for scale in scales):
+        parser.error('Scales must be 1 or more')
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+    fixture_store = FixtureStore(args.fixture_dir)
+    results = []
+    for shop_class in SHOP_CLASSES:
+        shop = shop_class('', '', '', fake=True)
+        shop.fixture_store = fixture_store
+        shop.fragment = not args.no_fragment
+        page = ''.join(shop.iter_fake_page())
+
+        for scale in scales:
+            stats = benchmark_shop(shop, scale_page(shop, page, scale), args.repeat)
+            stats['scale'] = scale
+            results.append(stats)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': time.time(), 'repeat': args.repeat, 'fragment': not args.no_fragment,
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.threshold)
+        print
+        if not regressions:
+            print 'No regressions over {0} beyond {1:.0%}'.format(args.compare, args.threshold)
+        for shop_name, scale, name, baseline_value, value in regressions:
+            print 'Regression: {0} at scale {1}: {2} went from {3:.6g} to {4:.6g} ({5:+.0%})'.format(
+                shop_name, scale, name, baseline_value, value, (value - baseline_value) / float(baseline_value))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
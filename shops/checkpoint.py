@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.checkpoint
+~~~~~~~~~~~~~~~~
+
+This module contains the checkpoints which record the progress of the crawls, so they can be resumed.
+
+"""
+
+import os
+import json
+import threading
+
+from product import Product
+from snapshot import get_shop_key
+
+
+class Checkpoint(object):
+    """Append-only record of the progress of the crawl of a shop, kept as a file of json lines.
+
+    Every line records a URL queued, a page done, a product found or the end of the crawl. Records are only appended,
+    and the file is flushed when a page is done, so keeping the checkpoint costs a buffered write per record. The
+    products found in a page which was not done are not lost either: the page is crawled again when resuming.
+
+    """
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        # Continue the crawl recorded by the previous run (only the first time the checkpoint is opened)
+        self.resume = resume
+        self.file = None
+        self.lock = threading.Lock()
+        # State recorded by the previous run: URLs queued (in order), URLs of the pages done, products and whether
+        # the crawl finished
+        self.urls = []
+        self.done = set()
+        self.products = {}
+        self.finished = False
+
+    def open(self):
+        """Start recording, reading first the state recorded by the previous run if it is resumed"""
+
+        if self.resume:
+            self.load()
+        if not os.path.isdir(os.path.dirname(self.filename) or '.'):
+            os.makedirs(os.path.dirname(self.filename))
+        self.file = open(self.filename, 'a' if self.resume else 'w')
+        self.resume = False
+
+    def load(self):
+        try:
+            f = open(self.filename, 'r')
+        except IOError:
+            return
+
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record may be incomplete if the previous run was killed while writing it
+                    break
+                if 'url' in record:
+                    self.urls.append(record['url'])
+                elif 'done' in record:
+                    self.done.add(record['done'])
+                elif 'product' in record:
+                    product = Product.from_dict(record['product'])
+                    self.products[product.id] = product
+                elif 'finished' in record:
+                    self.finished = True
+
+    def write(self, record, flush=False):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            if flush:
+                self.file.flush()
+
+    def url_queued(self, url):
+        self.write({'url': url})
+
+    def page_done(self, url):
+        self.write({'done': url}, flush=True)
+
+    def product_found(self, product):
+        self.write({'product': product.to_dict()})
+
+    def finish(self):
+        self.write({'finished': True}, flush=True)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        # The state of the previous run is not needed anymore
+        self.urls = []
+        self.done = set()
+        self.products = {}
+
+    def remove(self):
+        """Remove the file, once the results of the crawl are safe"""
+
+        self.close()
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+class CheckpointStore(object):
+    """Store of the checkpoints of the crawls of every shop list (or catalog) of every user"""
+
+    def __init__(self, directory='data/checkpoints', resume=False):
+        self.directory = directory
+        # Resume the crawls recorded by the previous run
+        self.resume = resume
+
+    def get(self, shop):
+        """Get the checkpoint of shop"""
+
+        return Checkpoint(os.path.join(self.directory, get_shop_key(shop) + '.jsonl'), self.resume)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.concurrency
+~~~~~~~~~~~~~~~~~
+
+This module contains the adaptive controller of the number of requests in flight to every host.
+
+"""
+
+import time
+import weakref
+import urlparse
+import threading
+
+from requests.adapters import BaseAdapter
+
+
+class HostLimit(object):
+    """Limit of the requests in flight to a host, adapted with additive increase and multiplicative decrease (AIMD).
+
+    Every request answered in time raises the limit by 1/limit (so about 1 per round of requests), while an error, a
+    429 Too Many Requests or a latency much higher than the usual one for the same path cuts it by decrease_factor.
+    A latency is much higher when it is latency_factor times the usual one and latency_margin seconds more, so the
+    jitter of the requests answered in a few milliseconds does not count. Only the requests sent after the last cut
+    can cut it again, so a burst of errors counts as a single one.
+
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=4, latency_factor=3.0, latency_margin=0.1,
+                 decrease_factor=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.latency_factor = latency_factor
+        self.latency_margin = latency_margin
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        # Moving average of the latency of the requests answered in time, by path (the pages of a host differ in size,
+        # so each one has its usual latency)
+        self.latencies = {}
+        self.last_decrease = 0.0
+        # Statistics
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.decreases = 0
+        self.max_limit = self.limit
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until a request can be sent. Return the time it is sent"""
+
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return time.time()
+
+    def release(self, start, error=False, throttled=False, path=None):
+        """Tell that the request to path sent at start was answered (or failed), adapting the limit"""
+
+        now = time.time()
+        latency = now - start
+        with self.condition:
+            self.in_flight -= 1
+            self.requests += 1
+            self.errors += error
+            self.throttled += throttled
+
+            usual_latency = self.latencies.get(path)
+            slow = (usual_latency is not None and latency > self.latency_factor * usual_latency and
+                    latency > usual_latency + self.latency_margin)
+            if error or throttled or slow:
+                if start > self.last_decrease:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+                    self.decreases += 1
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                self.max_limit = max(self.max_limit, self.limit)
+
+            if not error and not throttled:
+                self.latencies[path] = latency if usual_latency is None else 0.8 * usual_latency + 0.2 * latency
+
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {'limit': int(self.limit),
+                    'max_limit': int(self.max_limit),
+                    'requests': self.requests,
+                    'errors': self.errors,
+                    'throttled': self.throttled,
+                    'decreases': self.decreases}
+
+
+class Slot(object):
+    """Place of a request in a HostLimit, from the time it is sent until its response is read"""
+
+    def __init__(self, limit, path):
+        self.limit = limit
+        self.path = path
+        self.start = limit.acquire()
+        self.released = False
+        self._lock = threading.Lock()
+
+    def release(self, error=False, throttled=False):
+        """Give the place back to the limit (only the first call counts)"""
+
+        with self._lock:
+            if self.released:
+                return
+            self.released = True
+        self.limit.release(self.start, error, throttled, self.path)
+
+
+class AdaptiveAdapter(BaseAdapter):
+    """Transport adapter which bounds the requests in flight to every host with a HostLimit, falling back to another
+    adapter to send them.
+
+    The adapter returns as soon as the headers are received (the body is read by the session afterwards), so the slot
+    of every request is released when the body of its response is read or closed, which is when urllib3 releases the
+    connection. Responses dropped without doing either release it as soon as they are freed. Responses without a body
+    (to HEAD requests, 204 and 304) release it right away.
+
+    """
+
+    def __init__(self, adapter, initial=2, minimum=1, maximum=4):
+        BaseAdapter.__init__(self)
+        self.adapter = adapter
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self._lock = threading.Lock()
+        self._limits = {}
+        # Weak references to the raw responses whose body has not been read yet
+        self._unread = set()
+
+    def get_limit(self, url):
+        """Get the limit of the host of url"""
+
+        parts = urlparse.urlsplit(url)
+        host = parts.scheme + '://' + parts.hostname
+        with self._lock:
+            if host not in self._limits:
+                self._limits[host] = HostLimit(self.initial, self.minimum, self.maximum)
+            return self._limits[host]
+
+    def send(self, request, **kwargs):
+        slot = Slot(self.get_limit(request.url), urlparse.urlsplit(request.url).path)
+        try:
+            resp = self.adapter.send(request, **kwargs)
+        except Exception:
+            slot.release(error=True)
+            raise
+
+        error = resp.status_code >= 500
+        throttled = resp.status_code == 429
+        raw = resp.raw
+        if request.method == 'HEAD' or resp.status_code in (204, 304) or not hasattr(raw, 'release_conn'):
+            slot.release(error, throttled)
+            return resp
+
+        # The raw response is only referenced weakly, so it is freed (and the slot released) as soon as it is dropped
+        release_conn = type(raw).release_conn
+
+        def release_collected(ref):
+            self._unread.discard(ref)
+            slot.release(error, throttled)
+        raw_ref = weakref.ref(raw, release_collected)
+
+        def release_body_conn():
+            self._unread.discard(raw_ref)
+            slot.release(error, throttled)
+            raw = raw_ref()
+            if raw is not None:
+                release_conn(raw)
+
+        raw.release_conn = release_body_conn
+        self._unread.add(raw_ref)
+        return resp
+
+    def close(self):
+        self.adapter.close()
+
+    def stats(self):
+        """Return a dictionary mapping every host to the statistics of its limit"""
+
+        with self._lock:
+            limits = self._limits.items()
+        return dict((host, limit.stats()) for host, limit in limits)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.connection_pool
+~~~~~~~~~~~~~~~~~~~~~
+
+This module contains the pool of HTTP connections shared by all the shop crawlers.
+
+"""
+
+import re
+import warnings
+import threading
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from concurrency import AdaptiveAdapter
+from single_flight import SingleFlightAdapter
+import tracing
+
+
+# Ranges [minimum, maximum) of the versions of requests and urllib3 the pools were tested with: requests 2.32 gets the
+# pools with get_connection_with_tls_context() instead of get_connection(), and urllib3 2 changed its pools
+TESTED_VERSIONS = ((requests, (2, 20), (2, 32)), (urllib3, (1, 24), (2, 0)))
+
+
+def check_versions():
+    """Warn if the versions of requests or urllib3 are out of the ranges tested"""
+
+    for module, minimum, maximum in TESTED_VERSIONS:
+        version = tuple(int(part) for part in re.findall(r'\d+', module.__version__)[:2])
+        if not minimum <= version < maximum:
+            warnings.warn('{0} {1} was not tested with the shared connection pool (tested from {2} to before {3})'
+                          .format(module.__name__, module.__version__, '.'.join(map(str, minimum)),
+                                  '.'.join(map(str, maximum))), RuntimeWarning)
+
+
+class PoolAdapter(HTTPAdapter):
+    """HTTPAdapter keeping the connection pool of every host, for their statistics.
+
+    When the pool of a host is replaced (the pools of at most pool_connections hosts are kept alive), the statistics of
+    the old one are kept in closed_stats. If trace is set, the pools are the tracing ones of shops.tracing.
+
+    """
+
+    def __init__(self, trace=False, **kwargs):
+        self.trace = trace
+        self._lock = threading.Lock()
+        # Last connection pool of every host, and the statistics of the ones replaced
+        self.pools = {}
+        self.closed_stats = {}
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        if self.trace:
+            self.poolmanager.pool_classes_by_scheme = tracing.POOL_CLASSES
+
+    def get_connection(self, url, proxies=None):
+        pool = HTTPAdapter.get_connection(self, url, proxies)
+        host = pool.scheme + '://' + pool.host
+        with self._lock:
+            old_pool = self.pools.get(host)
+            if old_pool is not pool:
+                if old_pool is not None:
+                    add_pool_stats(self.closed_stats, old_pool)
+                self.pools[host] = pool
+        return pool
+
+    def stats(self):
+        """Return a dictionary mapping every host to the number of connections opened and requests sent to it"""
+
+        with self._lock:
+            stats = dict((host, dict(host_stats)) for host, host_stats in self.closed_stats.items())
+            for pool in self.pools.values():
+                add_pool_stats(stats, pool)
+        return stats
+
+
+def add_pool_stats(stats, pool):
+    """Add the number of connections opened and requests sent by a connection pool to the statistics of its host"""
+
+    host_stats = stats.setdefault(pool.scheme + '://' + pool.host, {'connections': 0, 'requests': 0})
+    host_stats['connections'] += pool.num_connections
+    host_stats['requests'] += pool.num_requests
+
+
+class ConnectionPool(object):
+    """Pool of keep-alive HTTP connections shared by the sessions of every shop.
+
+    Connections (and so their TLS sessions and the DNS lookups done to open them) are reused across sessions, lists
+    and shops. At most max_per_host connections are opened to every host: when all of them are busy, new requests
+    wait until one of them is released. The pools of at most max_hosts hosts are kept alive at the same time.
+
+    If adaptive is set, the requests in flight to every host are bounded by an AdaptiveAdapter too, which finds how
+    many of the max_per_host connections the host copes with. If trace is set, the connections record the timings of
+    their DNS lookup, connect and TLS handshake, to be traced by the sessions (see shops.tracing). If merge is set,
+    identical GET requests without cookies sent at the same time by several sessions are merged by a
+    SingleFlightAdapter.
+
+    """
+
+    def __init__(self, max_hosts=10, max_per_host=4, adaptive=False, trace=False, merge=False):
+        check_versions()
+        self.http_adapter = PoolAdapter(trace, pool_connections=max_hosts, pool_maxsize=max_per_host, pool_block=True)
+        # Adapter to be used by the sessions
+        self.adapter = self.http_adapter
+        if adaptive:
+            self.adapter = AdaptiveAdapter(self.http_adapter, maximum=max_per_host)
+        if merge:
+            self.adapter = SingleFlightAdapter(self.adapter)
+
+    def mount(self, session, adapter=None):
+        """Make session use the shared connections, optionally through an adapter wrapping the shared one"""
+
+        session.mount('http://', adapter if adapter is not None else self.adapter)
+        session.mount('https://', adapter if adapter is not None else self.adapter)
+
+    def stats(self):
+        """Return a dictionary mapping every host to the number of connections opened and requests sent to it"""
+
+        stats = self.http_adapter.stats()
+        for host_stats in stats.values():
+            host_stats['reused'] = max(0, host_stats['requests'] - host_stats['connections'])
+        return stats
+
+    def limits(self):
+        """Return a dictionary mapping every host to the statistics of its adaptive limit (empty if not adaptive)"""
+
+        adapter = self.adapter
+        if isinstance(adapter, SingleFlightAdapter):
+            adapter = adapter.adapter
+        if isinstance(adapter, AdaptiveAdapter):
+            return adapter.stats()
+        return {}
+
+    def merged(self):
+        """Return the number of requests merged into others (0 if requests are not merged)"""
+
+        if isinstance(self.adapter, SingleFlightAdapter):
+            return self.adapter.merged
+        return 0
+
+    def close(self):
+        self.adapter.close()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool():
+    """Get the connection pool shared by all the shops, creating it on first use"""
+
+    global _default_pool
+
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+        return _default_pool
+
+
+def set_default_pool(pool):
+    """Replace the connection pool shared by all the shops"""
+
+    global _default_pool
+
+    with _default_pool_lock:
+        _default_pool = pool
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.disk_store
+~~~~~~~~~~~~~~~~
+
+This module contains what the on-disk stores share: the atomic write of their files and the size-bounded store of
+entries evicted in least recently used order, on which the caches are built.
+
+"""
+
+import os
+import time
+import tempfile
+import threading
+
+
+# Mask of the permissions of the files created (read once, as it can only be read by changing it)
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def write_atomic(filename, data, mode=0666):
+    """Write data to filename, created with the permissions mode (less the umask).
+
+    The data is written to a temporary file of its own which is then renamed, so a crash never leaves a truncated file
+    and several threads can write the same file at the same time (the last rename wins).
+
+    """
+
+    directory, name = os.path.split(filename)
+    fd, tmp_filename = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory or '.')
+    try:
+        os.fchmod(fd, mode & ~UMASK)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_filename, filename)
+    except Exception:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+
+class DiskStore(object):
+    """Size-bounded on-disk store of entries, saved as a file per extension: <key><extension>.
+
+    The size of an entry is the size of its file with the first extension. When the entries take more than max_size
+    bytes, the least recently used ones are evicted. The statistics are counted under the lock of the store, with
+    count().
+
+    """
+
+    def __init__(self, directory, max_size, extensions):
+        self.directory = directory
+        self.max_size = max_size
+        self.extensions = extensions
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        # Index of the entries in the store: key -> [size, last access time]
+        self._index = {}
+        self._size = 0
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                if filename.endswith(self.extensions[0]):
+                    path = os.path.join(self.directory, filename)
+                    size = os.path.getsize(path)
+                    self._index[filename[:-len(self.extensions[0])]] = [size, os.path.getatime(path)]
+                    self._size += size
+        else:
+            os.makedirs(self.directory)
+
+    def get_path(self, key, extension):
+        """Get the file of the entry key with the given extension"""
+
+        return os.path.join(self.directory, key + extension)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._index
+
+    def touch(self, key):
+        """Mark the entry key as just used. Return whether it is in the store"""
+
+        with self._lock:
+            if key not in self._index:
+                return False
+            self._index[key][1] = time.time()
+
+        # Keep the access time on disk too, for the evictions of the next runs
+        try:
+            os.utime(self.get_path(key, self.extensions[0]), None)
+        except OSError:
+            pass
+        return True
+
+    def add(self, key, size):
+        """Add the entry key, whose files have just been written, evicting the least recently used entries if the
+        store gets too big"""
+
+        with self._lock:
+            if key in self._index:
+                self._size -= self._index[key][0]
+            self._index[key] = [size, time.time()]
+            self._size += size
+
+            while self._size > self.max_size:
+                lru_key = min(self._index, key=lambda k: self._index[k][1])
+                self._remove(lru_key)
+                self.evictions += 1
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        self._size -= self._index.pop(key, [0])[0]
+        for extension in self.extensions:
+            try:
+                os.remove(self.get_path(key, extension))
+            except OSError:
+                pass
+
+    def count(self, *names):
+        """Add one to each of the statistics names"""
+
+        with self._lock:
+            for name in names:
+                setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._index),
+                    'size': self._size}
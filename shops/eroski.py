@@ -9,18 +9,41 @@ This module contains the class implementing the crawler for Eroski.
 """
 
 import re
-import requests
-import lxml.html
+
+from lxml.etree import XPath
 
 from shop import Shop
 from product import Product
+from steps import StepGraph
+from extract import RowExtractor, parse_price
+
+
+# Path of the table holding the fields of a product, from its row
+PRODUCT_TABLE_PATH = "./td/table/tr/td/table/tr/td[3]/table"
 
 
 class Eroski(Shop):
     """Eroski crawler"""
 
-    def __init__(self, username, password, list_name, debug=False, verbose=False, fake=False):
-        Shop.__init__(self, debug=debug, verbose=verbose, fake=fake)
+    product_list_marker = 'id="conte"'
+    catalog_url = 'http://www.compraonline.grupoeroski.com/ecoventa/actions/mostrarCategoria.do'
+    catalog_link_xpath = XPath("//a[contains(@href, 'mostrarCategoria.do?')]/@href")
+
+    # XPath expressions used to find the product list, compiled once
+    list_link_xpath = XPath("//div[@id='divListas']//a[text()=concat('- ', $list_name)]/@href")
+    product_rows_xpath = XPath("//table[@id='conte']/form/tr[starts-with(@id, 'prod_') or starts-with(@id, 'categ_')]")
+    # Start tag of the table holding the products, the only fragment of the page parsed
+    product_table_re = re.compile(r'<table\b[^>]*\bid="conte"')
+    # Fields of the category rows and the product rows
+    category_extractor = RowExtractor(category="./td/table/tr/td[2]/p")
+    row_extractor = RowExtractor(
+        unavailable=PRODUCT_TABLE_PATH +
+        "/tr[3]/td/table/tr/td[@class='sub_menu_11']/a/strong[text()='Busca Sustituto']",
+        name=PRODUCT_TABLE_PATH + "/tr/td/table/tr/td[@class='menu_sup11']",
+        price=PRODUCT_TABLE_PATH + "/tr[3]/td/table/tr/td[@class='menu_12_rojo_sin']/strong")
+
+    def __init__(self, username, password, list_name, debug=False, verbose=False, fake=False, base_url=None):
+        Shop.__init__(self, debug=debug, verbose=verbose, fake=fake, base_url=base_url)
         # Credentials to access to the shop
         self.username = username
         self.password = password
@@ -68,82 +91,99 @@ class Eroski(Shop):
 
         return round(round(unitary_price, 4), 2), unit  # TODO: Warning!!! floats are not precise
 
-    def get_product_list_page(self):
-        """Get the HTML page which has the product list"""
+    def login(self, session):
+        """Log in the shop server using session.
 
-        session = requests.session()
+        Every request needs the server session started by the previous one, so the steps run one after another.
 
-        resp = session.get('http://www.compraonline.grupoeroski.com/ecoventa/index.jsp', allow_redirects=False)
-        self.log(resp)
+        """
 
-        form_params = {'from': 'index',
-                       'tipo': 'P',
-                       'CajaLaboral': 'null',
-                       'shlogid': self.username,
-                       'shlpswd': self.password}
-        resp = session.post('https://www.compraonline.grupoeroski.com/ecoventa/actions/accesoUsuarioRegistrado.do',
-                            data=form_params)
-        self.log(resp)
-        #resp = session.get('http://www.compraonline.grupoeroski.com/ecoventa/actions/mostrarDireccionesEnvio.do')
+        def get_home(results):
+            resp = session.get('http://www.compraonline.grupoeroski.com/ecoventa/index.jsp', allow_redirects=False)
+            self.log(resp)
 
-        form_params = {'ultimasCompras': 'NO',
-                       'sarfnbr': '3251371'}
-        resp = session.post('https://www.compraonline.grupoeroski.com/ecoventa/actions/seleccionarDireccionEnvio.do',
-                            data=form_params, allow_redirects=False)
-        self.log(resp)
+        def post_credentials(results):
+            form_params = {'from': 'index',
+                           'tipo': 'P',
+                           'CajaLaboral': 'null',
+                           'shlogid': self.username,
+                           'shlpswd': self.password}
+            resp = session.post('https://www.compraonline.grupoeroski.com/ecoventa/actions/'
+                                'accesoUsuarioRegistrado.do', data=form_params)
+            self.log(resp)
+            #resp = session.get('http://www.compraonline.grupoeroski.com/ecoventa/actions/mostrarDireccionesEnvio.do')
+
+        def select_address(results):
+            form_params = {'ultimasCompras': 'NO',
+                           'sarfnbr': '3251371'}
+            resp = session.post('https://www.compraonline.grupoeroski.com/ecoventa/actions/'
+                                'seleccionarDireccionEnvio.do', data=form_params, allow_redirects=False)
+            self.log(resp)
+
+        steps = StepGraph(session)
+        steps.add('home', get_home)
+        steps.add('credentials', post_credentials, depends=('home',))
+        steps.add('address', select_address, depends=('credentials',))
+        self.run_steps(steps)
+
+    def find_product_list_url(self, session):
+        """Find the URL of the product list page, once logged in"""
 
         resp = session.get('http://www.compraonline.grupoeroski.com/ecoventa/actions/mostrarListaHabitualUsuario.do')
         self.log(resp)
 
-        html_tree = lxml.html.fromstring(resp.text, parser=lxml.html.HTMLParser(encoding='utf-8'))
+        html_tree = self.parse_html(resp.content)
         try:
-            url = html_tree.xpath("//div[@id='divListas']//"
-                                  "a[text()='- " + self.list_name + "']")[0].attrib['href']
+            url = self.list_link_xpath(html_tree, list_name=self.list_name)[0]
         except:
             raise ValueError('List name "' + self.list_name + '" not found')
 
-        resp = session.get('http://www.compraonline.grupoeroski.com' + url.strip())
-        self.log(resp)
+        return 'http://www.compraonline.grupoeroski.com' + url.strip()
+
+    def find_product_rows(self, html_tree):
+        """Find the elements holding the products in the product list page"""
+
+        return self.product_rows_xpath(html_tree)
 
-        return resp.text
+    def is_product_row(self, element):
+        """Check whether element holds a product (used when the page is parsed as a stream)"""
 
-    def parse_product_list_page(self, html_page):
-        """Parse the HTML page which has the product list and populate the product_dict"""
+        if not element.get('id', '').startswith(('prod_', 'categ_')):
+            return False
+        form = element.getparent()
+        if form is None or form.tag != 'form':
+            return False
+        table = form.getparent()
+        return table is not None and table.tag == 'table' and table.get('id') == 'conte'
 
-        html_tree = lxml.html.fromstring(html_page, parser=lxml.html.HTMLParser(encoding='utf-8'))
+    def parse_product_row(self, product_item, context):
+        """Parse an element holding a product and add the product to product_dict"""
 
-        product_list = html_tree.xpath("//table[@id='conte']/form/tr[starts-with(@id, 'prod_') or "
-                                       "starts-with(@id, 'categ_')]")
-        #print len(product_list)
+        # Get product category
+        product_id = product_item.attrib['id']
+        if product_id.startswith('categ_'):
+            if not product_id.endswith('_2'):
+                context['category'] = self.category_extractor.extract(product_item)['category'].strip(' >')
+                #print context['category']
+            return
 
-        for product_item in product_list:
-            # Get product category
-            product_id = product_item.attrib['id']
-            if product_id.startswith('categ_'):
-                if not product_id.endswith('_2'):
-                    product_category = product_item.xpath("./td/table/tr/td[2]/p")[0].text.strip(' >')
-                    #print product_category
-                continue
+        fields = self.row_extractor.extract(product_item)
 
-            base_xpath = "./td/table/tr/td/table/tr/td[3]/table"
-            # Check whether the product is available
-            if len(product_item.xpath(base_xpath + "/tr[3]/td/table/tr/td[@class='sub_menu_11']/a/"
-                                                   "strong[text()='Busca Sustituto']")) > 0:
-                continue
+        # Check whether the product is available
+        if 'unavailable' in fields:
+            return
 
-            product_id = product_id.partition('_')[2]
-            product_name = product_item.xpath(base_xpath + "/tr/td/table/tr/td[@class='menu_sup11']")[0].\
-                                              text_content().strip()
-            product_name = product_name.encode('utf-8')
-            product_price = float(product_item.xpath(base_xpath +
-                                                     "/tr[3]/td/table/tr/td[@class='menu_12_rojo_sin']/strong")[0].\
-                                                     text.partition(' ')[0].replace(',', '.'))
+        product_id = product_id.partition('_')[2]
+        product_name = fields['name'].strip()
+        product_name = product_name.encode('utf-8')
+        product_price = parse_price(fields['price'])
 
-            # The following are fixings to normalize shop "bugs"
-            if product_id == '900782_2058535':
-                product_name = product_name.replace('3x80', '3x60')
+        # The following are fixings to normalize shop "bugs"
+        if product_id == '900782_2058535':
+            product_name = product_name.replace('3x80', '3x60')
 
-            product_unitary_price, product_unit = self.get_unitary_price(product_price, product_name, product_category)
+        product_unitary_price, product_unit = self.get_unitary_price(product_price, product_name,
+                                                                    context['category'])
 
-            Shop.add_product(self,
-                             Product(product_id, product_name, product_price, product_unitary_price, product_unit))
+        Shop.add_product(self,
+                         Product(product_id, product_name, product_price, product_unitary_price, product_unit))
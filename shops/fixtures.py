@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.fixtures
+~~~~~~~~~~~~~~
+
+This module contains the store of the product list pages captured from the shops, to replay them later.
+
+Pages are kept compressed with zlib and named by the sha1 of their content, so a page which did not change is stored
+only once. Every capture is recorded in an append-only index (a json line with the time, the shop, the list and the
+hash of the page), so any page captured in the past can be found again. Pages are loaded through mmap and decompressed
+chunk by chunk, straight into the parser.
+
+The store can be managed from the command line too:
+
+    python -m shops.fixtures list
+    python -m shops.fixtures add Mercadona data/Mercadona_fake_page.html
+
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import zlib
+import hashlib
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+
+
+class FixtureStore(object):
+    """Store of compressed, content-addressed pages with a time index"""
+
+    def __init__(self, directory='data/fixtures', chunk_size=64 * 1024):
+        self.directory = directory
+        # Size of the compressed chunks decompressed at once when a page is loaded
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+
+    def get_filename(self, page_hash):
+        return os.path.join(self.directory, 'objects', page_hash[:2], page_hash + '.z')
+
+    def capture(self, shop_name, list_key, page):
+        """Store page (bytes) as captured now from the list of a shop. Return its hash"""
+
+        writer = ObjectWriter(self)
+        writer.write(page)
+        return self._finish_capture(shop_name, list_key, writer)
+
+    def capture_stream(self, shop_name, list_key, chunks):
+        """Iterate over chunks (the bytes of a page being downloaded), compressing them as they come and storing the
+        page once all of them are read"""
+
+        writer = ObjectWriter(self)
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+                yield chunk
+        except:
+            writer.abort()
+            raise
+        self._finish_capture(shop_name, list_key, writer)
+
+    def _finish_capture(self, shop_name, list_key, writer):
+        page_hash = writer.close()
+        record = {'time': time.time(), 'shop': shop_name, 'list': list_key, 'hash': page_hash, 'size': writer.size}
+        with self._lock:
+            with open(os.path.join(self.directory, 'index.jsonl'), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        return page_hash
+
+    def index(self):
+        """Return the records of the index, oldest first"""
+
+        try:
+            f = open(os.path.join(self.directory, 'index.jsonl'), 'r')
+        except IOError:
+            return []
+
+        records = []
+        with f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # The last record may be incomplete if a run was killed while writing it
+                    break
+        return records
+
+    def find(self, shop_name, list_key=None, at=None):
+        """Find the hash of the last page captured from the list of a shop at or before time at (None means now).
+
+        If no page was captured from the list, the last page captured from any list of the shop is found. Return None
+        if there is no page.
+
+        """
+
+        records = [record for record in self.index()
+                   if record['shop'] == shop_name and (at is None or record['time'] <= at)]
+        same_list = [record for record in records if record['list'] == list_key]
+        records = same_list or records
+        return records[-1]['hash'] if records else None
+
+    def iter_page(self, page_hash):
+        """Iterate over the decompressed chunks of a page, read through mmap"""
+
+        with open(self.get_filename(page_hash), 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            decompressor = zlib.decompressobj()
+            for start in xrange(0, len(data), self.chunk_size):
+                chunk = decompressor.decompress(data[start:start + self.chunk_size])
+                if chunk:
+                    yield chunk
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+        finally:
+            data.close()
+
+    def load(self, page_hash):
+        """Get the bytes of a page"""
+
+        return ''.join(self.iter_page(page_hash))
+
+
+class ObjectWriter(object):
+    """Writer compressing a page into a new object of a FixtureStore, named by its hash once it is closed"""
+
+    def __init__(self, store):
+        self.store = store
+        self.sha1 = hashlib.sha1()
+        self.compressor = zlib.compressobj(9)
+        self.size = 0
+
+        objects_dir = os.path.join(store.directory, 'objects')
+        if not os.path.isdir(objects_dir):
+            os.makedirs(objects_dir)
+        fd, self.tmp_filename = tempfile.mkstemp(dir=objects_dir)
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self.sha1.update(chunk)
+        self.size += len(chunk)
+        self.file.write(self.compressor.compress(chunk))
+
+    def close(self):
+        """Finish the object, unless it exists already (the page did not change). Return its hash"""
+
+        self.file.write(self.compressor.flush())
+        self.file.close()
+
+        page_hash = self.sha1.hexdigest()
+        filename = self.store.get_filename(page_hash)
+        if os.path.exists(filename):
+            os.remove(self.tmp_filename)
+        else:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            os.rename(self.tmp_filename, filename)
+        return page_hash
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_filename)
+
+
+def parse_time(text):
+    """Parse a time given as YYYYmmdd_HHMMSS (as in the names of the exported files) into a timestamp"""
+
+    return time.mktime(datetime.strptime(text, '%Y%m%d_%H%M%S').timetuple())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Store of the pages captured from the shops')
+    parser.add_argument('--dir', default='data/fixtures', help='directory of the store (default: %(default)s)')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('list', help='list the pages captured')
+    add_parser = subparsers.add_parser('add', help='add a page saved in a file')
+    add_parser.add_argument('shop', help='name of the shop class (e.g. Mercadona)')
+    add_parser.add_argument('filename', help='file with the page')
+    add_parser.add_argument('--list', default=None, help='key of the shopping list of the page')
+    args = parser.parse_args()
+
+    store = FixtureStore(args.dir)
+    if args.command == 'add':
+        with open(args.filename, 'rb') as f:
+            print store.capture(args.shop, args.list, f.read())
+    else:
+        for record in store.index():
+            print '{0} {1:<10} {2} {3:>9} {4}'.format(datetime.fromtimestamp(record['time']).strftime('%Y%m%d_%H%M%S'),
+                                                      record['shop'], record['hash'], record['size'],
+                                                      record['list'] or '')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
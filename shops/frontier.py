@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.frontier
+~~~~~~~~~~~~~~
+
+This module contains the URL frontier and the per host throttle used to crawl the whole catalog of a shop.
+
+"""
+
+import time
+import heapq
+import hashlib
+import tempfile
+import threading
+import urlparse
+import collections
+
+from requests.utils import requote_uri
+
+
+def normalize_url(url):
+    """Turn url into ASCII bytes (non-ASCII characters are percent-quoted as utf-8), without the fragment"""
+
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return requote_uri(urlparse.urldefrag(url)[0])
+
+
+class DigestSet(object):
+    """Set of digests of digest_size bytes, keeping at most max_size of them in memory.
+
+    When there are more, the digests in memory are merged into a sorted temporary file, which is searched by bisection,
+    so the memory used does not grow with the number of digests.
+
+    """
+
+    def __init__(self, digest_size=8, max_size=100000):
+        self.digest_size = digest_size
+        self.max_size = max_size
+        self.memory = set()
+        # Sorted file with the digests which did not fit in memory, and how many there are
+        self.file = None
+        self.file_count = 0
+
+    def __contains__(self, digest):
+        if digest in self.memory:
+            return True
+
+        low, high = 0, self.file_count
+        while low < high:
+            middle = (low + high) // 2
+            self.file.seek(middle * self.digest_size)
+            value = self.file.read(self.digest_size)
+            if value < digest:
+                low = middle + 1
+            elif value > digest:
+                high = middle
+            else:
+                return True
+        return False
+
+    def add(self, digest):
+        self.memory.add(digest)
+        if len(self.memory) >= self.max_size:
+            self._merge()
+
+    def _merge(self):
+        """Merge the digests in memory into the file"""
+
+        merged = tempfile.TemporaryFile()
+        count = 0
+        last = None
+        for digest in heapq.merge(self._read_file(), sorted(self.memory)):
+            if digest != last:
+                merged.write(digest)
+                count += 1
+                last = digest
+
+        if self.file is not None:
+            self.file.close()
+        self.file = merged
+        self.file_count = count
+        self.memory = set()
+
+    def _read_file(self):
+        if self.file is None:
+            return
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(self.digest_size * 4096)
+            if not chunk:
+                return
+            for position in range(0, len(chunk), self.digest_size):
+                yield chunk[position:position + self.digest_size]
+
+
+class Frontier(object):
+    """Queue of the URLs to be crawled, shared by several workers.
+
+    Every URL is queued only once: the URLs seen are kept as 8 byte digests in a DigestSet, with at most max_seen of
+    them in memory. At most max_size URLs are queued in memory: the rest are spilled to a temporary file and read back
+    as the queue drains. So the memory used does not grow with the size of the catalog.
+
+    If checkpoint is set, the URLs queued and the pages done are recorded in it.
+
+    """
+
+    def __init__(self, max_size=1000, checkpoint=None, max_seen=100000):
+        self.max_size = max_size
+        self.checkpoint = checkpoint
+        self.queue = collections.deque()
+        self.seen = DigestSet(8, max_seen)
+        # File with the URLs which did not fit in the queue, and the positions where they are read and written
+        self.spill = None
+        self.spill_read = 0
+        self.spill_write = 0
+        # URLs got by workers and not done yet
+        self.pending = 0
+        # Number of URLs done and failed
+        self.done_count = 0
+        self.failed_count = 0
+        self.condition = threading.Condition()
+
+    def add(self, url):
+        """Queue url if it was not seen before. Return whether it was queued"""
+
+        url = normalize_url(url)
+        digest = hashlib.sha1(url).digest()[:8]
+
+        with self.condition:
+            if digest in self.seen:
+                return False
+            self.seen.add(digest)
+
+            # Keep the order: once a URL is spilled, the next ones are spilled too until the spill is read back
+            if len(self.queue) < self.max_size and self.spill_read == self.spill_write:
+                self.queue.append(url)
+            else:
+                if self.spill is None:
+                    self.spill = tempfile.TemporaryFile()
+                self.spill.seek(self.spill_write)
+                self.spill.write(url + '\n')
+                self.spill_write = self.spill.tell()
+            self.condition.notify()
+
+        if self.checkpoint is not None:
+            self.checkpoint.url_queued(url)
+        return True
+
+    def skip(self, url):
+        """Take url as seen, so it is never queued (e.g. it was crawled by a previous run)"""
+
+        with self.condition:
+            self.seen.add(hashlib.sha1(normalize_url(url)).digest()[:8])
+
+    def get(self):
+        """Get the next URL to be crawled, waiting for the other workers if the queue is empty.
+
+        Return None when the crawl is over: the queue is empty and no worker is crawling a URL which could add more.
+        done() must be called for every URL got.
+
+        """
+
+        with self.condition:
+            while not self.queue:
+                if self.spill_read < self.spill_write:
+                    self._read_spill()
+                elif self.pending == 0:
+                    self.condition.notify_all()
+                    return None
+                else:
+                    self.condition.wait()
+
+            self.pending += 1
+            return self.queue.popleft()
+
+    def done(self, url, failed=False):
+        """Tell that a URL got with get() was crawled"""
+
+        if self.checkpoint is not None and not failed:
+            self.checkpoint.page_done(url)
+
+        with self.condition:
+            self.pending -= 1
+            self.done_count += 1
+            if failed:
+                self.failed_count += 1
+            self.condition.notify_all()
+
+    def _read_spill(self):
+        self.spill.seek(self.spill_read)
+        while len(self.queue) < self.max_size and self.spill_read < self.spill_write:
+            self.queue.append(self.spill.readline().rstrip('\n'))
+            self.spill_read = self.spill.tell()
+        if self.spill_read == self.spill_write:
+            self.spill.truncate(0)
+            self.spill_read = self.spill_write = 0
+
+
+class HostThrottle(object):
+    """Politeness throttle, spacing the requests to every host at least delay seconds"""
+
+    def __init__(self, delay, sleep=time.sleep):
+        self.delay = delay
+        self.sleep = sleep
+        # Time when the next request to every host is allowed
+        self.next_time = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        """Wait until a request to the host of url is allowed"""
+
+        host = urlparse.urlsplit(url).netloc
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time.get(host, now))
+            self.next_time[host] = start + self.delay
+        if start > now:
+            self.sleep(start - now)
@@ -9,18 +9,39 @@ This module contains the class implementing the crawler for Hipercor.
 """
 
 import re
-import requests
-import lxml.html
+
+from lxml.etree import XPath
 
 from shop import Shop
 from product import Product
+from extract import RowExtractor, parse_price
+from steps import StepGraph
 
 
 class Hipercor(Shop):
     """Hipercor crawler"""
 
-    def __init__(self, username, password, list_name, debug=False, verbose=False, fake=False):
-        Shop.__init__(self, debug=debug, verbose=verbose, fake=fake)
+    product_list_marker = 'shopping-cart-table'
+    catalog_url = 'http://www.hipercor.es/hipercor/sm2/catalog/categoryView.jsp'
+    catalog_link_xpath = XPath("//a[contains(@href, 'categoryView.jsp?')]/@href")
+
+    # XPath expressions used to log in and to find the product list, compiled once
+    session_conf_xpath = XPath("//input[@name='_dynSessConf']/@value")
+    input_value_xpath = XPath("//input[@name=$name]/@value")
+    list_link_xpath = XPath("//div[@id='contenedor_popup_desplegable_mislistas']//a[span[text()=$list_name]]/@href")
+    product_rows_xpath = XPath("//table[@id='shopping-cart-table']/tbody/tr[not(@class)]")
+    # Start tag of the table holding the products, the only fragment of the page parsed
+    product_table_re = re.compile(r'<table\b[^>]*\bid="shopping-cart-table"')
+    # Fields of the product rows
+    row_extractor = RowExtractor(
+        unavailable="./td[3]/span[text()='Producto no disponible']",
+        image=".//div[@class='cart_product_img']//img/@src",
+        name=".//div[@class='cart_product_txt']/h3/a/span",
+        price=".//p[@class='ahora']/span",
+        unitary_price=".//div[contains(concat(' ', normalize-space(@class), ' '), ' precio_kg ')]")
+
+    def __init__(self, username, password, list_name, debug=False, verbose=False, fake=False, base_url=None):
+        Shop.__init__(self, debug=debug, verbose=verbose, fake=fake, base_url=base_url)
         # Credentials to access to the shop
         self.username = username
         self.password = password
@@ -61,122 +82,155 @@ class Hipercor(Shop):
 
         return round(round(unitary_price, 4), 2), unit  # TODO: Warning!!! floats are not precise
 
-    def get_product_list_page(self):
-        """Get the HTML page which has the product list"""
-
-        session = requests.session()
-
-        #resp = session.get('http://www.hipercor.es/')
-        resp = session.get('http://www.hipercor.es/hiper')
-        self.log(resp)
-
-        resp = session.get('https://www.hipercor.es/hipercor/sm2/login/login.jsp')
-        self.log(resp)
-
-        html_tree = lxml.html.fromstring(resp.text, parser=lxml.html.HTMLParser(encoding='utf-8'))
-        dynSessConf = html_tree.xpath("//input[@name='_dynSessConf']")[0].attrib['value']
-
-        # Petición para forzar la cookie PD-H-SESSION-ID
-        resp = session.get('https://www.hipercor.es/profile2/profile/auth/TAM/AutenticaUsuario?'
-                           'migrar=1&datincom=0&urltam=https://www.hipercor.es/hipercor/sm2/login/login.jsp')
-        self.log(resp)
-
-        form_params = {'_dyncharset': 'iso-8859-15',
-                       '_dynSessConf': dynSessConf,
-                       'pag_regreso': 'https://www.hipercor.es/hipercor/sm2/login/login.jsp',
-                       'pag_error': 'https://www.hipercor.es/hipercor/sm2/login/login.jsp?_errorValidationTAM=true',
-                       'grupo': 'ECI',
-                       'Username': self.username,
-                       'password': self.password,
-                       'group1': 'homeDelivery'}
-        resp = session.post('https://www.hipercor.es/profile2/profile/LoginServlet?'
-                            '_DARGS=/sm2/common/public/homeHipercorContainer.jsp', data=form_params)
-        self.log(resp)
-
-        html_tree = lxml.html.fromstring(resp.text, parser=lxml.html.HTMLParser(encoding='utf-8'))
-        username = html_tree.xpath("//input[@name='username']")[0].attrib['value']
-        password = html_tree.xpath("//input[@name='password']")[0].attrib['value']
-        form_params = {'login-form-type': 'pwd',
-                       'username': username,
-                       'password': password}
-        resp = session.post('https://www.hipercor.es/pkmslogin.form?'
-                            'pag_error=https://www.hipercor.es/hipercor/sm2/login/login.jsp?_errorValidationTAM=true',
-                            data=form_params)
-        self.log(resp)
-        #resp = session.get('https://www.hipercor.es/profile2/profile/auth/TAM/AutenticaUsuario?'
-        #                   'migrar=1&datincom=0&urltam=https://www.hipercor.es/hipercor/sm2/login/login.jsp',
-        #                   allow_redirects=False)
-        #resp = session.get(resp.headers['Location'], allow_redirects = False)
-
-        html_tree = lxml.html.fromstring(resp.text, parser=lxml.html.HTMLParser(encoding='utf-8'))
-        dynSessConf = html_tree.xpath("//input[@name='_dynSessConf']")[0].attrib['value']
-        form_params = {'_dyncharset': 'iso-8859-15',
-                       '_dynSessConf': dynSessConf,
-                       'group1': 'homeDelivery',
-                       '_D:group1': ' ',
-                       '_D:group1': ' ',
-                       '_D:group1': ' ',
-                       'Aceptar': 'Aceptar',
-                       '_D:Aceptar': ' ',
-                       '_DARGS': '/sm2/login/LoginOptionsLoggedUser.jsp.frmlogin'}
-        resp = session.post('https://www.hipercor.es/hipercor/sm2/login/login.jsp?'
-                            '_DARGS=/sm2/login/LoginOptionsLoggedUser.jsp.frmlogin', data=form_params)
-        self.log(resp)
-        #resp = session.get(resp.headers['Location'], allow_redirects = False)
-        #resp = session.get(resp.headers['Location'], allow_redirects = False)
-        #resp = session.get(resp.headers['Location'], allow_redirects = False)
+    def login(self, session):
+        """Log in the shop server using session.
+
+        The login page and the TAM cookie requests do not depend on each other, so they are issued at the same time.
+        Both wait for the home page, which starts the server session: issued without a session cookie, every request
+        would start a different server session.
+
+        """
+
+        def get_home(results):
+            #resp = session.get('http://www.hipercor.es/')
+            resp = session.get('http://www.hipercor.es/hiper')
+            self.log(resp)
+
+        def get_login_page(results):
+            resp = session.get('https://www.hipercor.es/hipercor/sm2/login/login.jsp')
+            self.log(resp)
+
+            html_tree = self.parse_html(resp.content)
+            return self.session_conf_xpath(html_tree)[0]
+
+        def force_tam_cookie(results):
+            # Petición para forzar la cookie PD-H-SESSION-ID
+            resp = session.get('https://www.hipercor.es/profile2/profile/auth/TAM/AutenticaUsuario?'
+                               'migrar=1&datincom=0&urltam=https://www.hipercor.es/hipercor/sm2/login/login.jsp')
+            self.log(resp)
+
+        def post_credentials(results):
+            form_params = {'_dyncharset': 'iso-8859-15',
+                           '_dynSessConf': results['login_page'],
+                           'pag_regreso': 'https://www.hipercor.es/hipercor/sm2/login/login.jsp',
+                           'pag_error': 'https://www.hipercor.es/hipercor/sm2/login/login.jsp?'
+                                        '_errorValidationTAM=true',
+                           'grupo': 'ECI',
+                           'Username': self.username,
+                           'password': self.password,
+                           'group1': 'homeDelivery'}
+            resp = session.post('https://www.hipercor.es/profile2/profile/LoginServlet?'
+                                '_DARGS=/sm2/common/public/homeHipercorContainer.jsp', data=form_params)
+            self.log(resp)
+
+            html_tree = self.parse_html(resp.content)
+            username = self.input_value_xpath(html_tree, name='username')[0]
+            password = self.input_value_xpath(html_tree, name='password')[0]
+            return username, password
+
+        def post_tam_login(results):
+            username, password = results['credentials']
+            form_params = {'login-form-type': 'pwd',
+                           'username': username,
+                           'password': password}
+            resp = session.post('https://www.hipercor.es/pkmslogin.form?'
+                                'pag_error=https://www.hipercor.es/hipercor/sm2/login/login.jsp?'
+                                '_errorValidationTAM=true',
+                                data=form_params)
+            self.log(resp)
+            #resp = session.get('https://www.hipercor.es/profile2/profile/auth/TAM/AutenticaUsuario?'
+            #                   'migrar=1&datincom=0&urltam=https://www.hipercor.es/hipercor/sm2/login/login.jsp',
+            #                   allow_redirects=False)
+            #resp = session.get(resp.headers['Location'], allow_redirects = False)
+
+            html_tree = self.parse_html(resp.content)
+            return self.session_conf_xpath(html_tree)[0]
+
+        def post_login_options(results):
+            form_params = {'_dyncharset': 'iso-8859-15',
+                           '_dynSessConf': results['tam_login'],
+                           'group1': 'homeDelivery',
+                           '_D:group1': ' ',
+                           '_D:group1': ' ',
+                           '_D:group1': ' ',
+                           'Aceptar': 'Aceptar',
+                           '_D:Aceptar': ' ',
+                           '_DARGS': '/sm2/login/LoginOptionsLoggedUser.jsp.frmlogin'}
+            resp = session.post('https://www.hipercor.es/hipercor/sm2/login/login.jsp?'
+                                '_DARGS=/sm2/login/LoginOptionsLoggedUser.jsp.frmlogin', data=form_params)
+            self.log(resp)
+            #resp = session.get(resp.headers['Location'], allow_redirects = False)
+            #resp = session.get(resp.headers['Location'], allow_redirects = False)
+            #resp = session.get(resp.headers['Location'], allow_redirects = False)
+
+        steps = StepGraph(session)
+        steps.add('home', get_home)
+        steps.add('login_page', get_login_page, depends=('home',))
+        steps.add('tam_cookie', force_tam_cookie, depends=('home',))
+        steps.add('credentials', post_credentials, depends=('login_page', 'tam_cookie'))
+        steps.add('tam_login', post_tam_login, depends=('credentials',))
+        steps.add('login_options', post_login_options, depends=('tam_login',))
+        self.run_steps(steps)
+
+    def find_product_list_url(self, session):
+        """Find the URL of the product list page, once logged in"""
 
         resp = session.get('http://www.hipercor.es/hipercor/sm2/wishlist/wishListView.jsp')
         self.log(resp)
 
-        html_tree = lxml.html.fromstring(resp.text, parser=lxml.html.HTMLParser(encoding='utf-8'))
+        html_tree = self.parse_html(resp.content)
         try:
-            url = html_tree.xpath("//div[@id='contenedor_popup_desplegable_mislistas']//"
-                                  "a[span[text()='" + self.list_name + "']]")[0].attrib['href']
+            url = self.list_link_xpath(html_tree, list_name=self.list_name)[0]
         except:
             raise ValueError('List name "' + self.list_name + '" not found')
 
-        resp = session.get('http://www.hipercor.es/' + url)
-        self.log(resp)
+        return 'http://www.hipercor.es/' + url
+
+    def find_product_rows(self, html_tree):
+        """Find the elements holding the products in the product list page"""
 
-        return resp.text
+        return self.product_rows_xpath(html_tree)
 
-    def parse_product_list_page(self, html_page):
-        """Parse the HTML page which has the product list and populate the product_dict"""
+    def is_product_row(self, element):
+        """Check whether element holds a product (used when the page is parsed as a stream)"""
 
-        html_tree = lxml.html.fromstring(html_page, parser=lxml.html.HTMLParser(encoding='utf-8'))
+        if 'class' in element.attrib:
+            return False
+        tbody = element.getparent()
+        if tbody is None or tbody.tag != 'tbody':
+            return False
+        table = tbody.getparent()
+        return table is not None and table.tag == 'table' and table.get('id') == 'shopping-cart-table'
 
-        product_list = html_tree.xpath("//table[@id='shopping-cart-table']/tbody/tr[not(@class)]")
-        #print len(product_list)
+    def parse_product_row(self, product_item, context):
+        """Parse an element holding a product and add the product to product_dict"""
 
-        for product_item in product_list:
-            # Check whether the product is available
-            if len(product_item.xpath("./td[3]/span[text()='Producto no disponible']")) > 0:
-                continue
+        fields = self.row_extractor.extract(product_item)
 
-            product_id = product_item.xpath(".//div[@class='cart_product_img']//img/@src")[0].split('/')
-            product_id = product_id[len(product_id) - 2]
+        # Check whether the product is available
+        if 'unavailable' in fields:
+            return
 
-            product_name = product_item.xpath(".//div[@class='cart_product_txt']/h3/a/span")[0].text
-            product_name = product_name.encode('utf-8')
+        product_id = fields['image'].split('/')
+        product_id = product_id[len(product_id) - 2].encode('utf-8')
 
-            product_price = float(product_item.xpath(".//p[@class='ahora']/span")[0].text.strip().\
-                                  partition(' ')[0].replace(',', '.'))
+        product_name = fields['name']
+        product_name = product_name.encode('utf-8')
 
-            product_unitary_price = product_item.xpath(".//div[contains(concat(' ', normalize-space(@class), ' '), "
-                                                       "' precio_kg ')]")
-            if len(product_unitary_price) > 0:
-                product_unitary_price = product_unitary_price[0].text.strip(' ()').partition(' / ')
-                product_unit = product_unitary_price[2]
-                product_unitary_price = float(product_unitary_price[0].partition(' ')[0].replace(',', '.'))
+        product_price = parse_price(fields['price'])
 
-                # The following are fixings to normalize shop "bugs"
-                if product_id == '0201030800187':
-                    product_unitary_price *= 2
+        if 'unitary_price' in fields:
+            product_unitary_price = fields['unitary_price'].strip(' ()').partition(' / ')
+            product_unit = product_unitary_price[2]
+            product_unitary_price = parse_price(product_unitary_price[0])
 
-                product_unitary_price, product_unit = self.normalize_unitary_price(product_unitary_price, product_unit)
-            else:
-                product_unitary_price, product_unit = self.get_unitary_price(product_price, product_name)
+            # The following are fixings to normalize shop "bugs"
+            if product_id == '0201030800187':
+                product_unitary_price *= 2
+
+            product_unitary_price, product_unit = self.normalize_unitary_price(product_unitary_price, product_unit)
+        else:
+            product_unitary_price, product_unit = self.get_unitary_price(product_price, product_name)
 
-            Shop.add_product(self,
-                             Product(product_id, product_name, product_price, product_unitary_price, product_unit))
+        Shop.add_product(self,
+                         Product(product_id, product_name, product_price, product_unitary_price, product_unit))
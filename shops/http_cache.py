@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.http_cache
+~~~~~~~~~~~~~~~~
+
+This module contains an on-disk HTTP cache to be plugged under the sessions of the shop crawlers.
+
+"""
+
+import re
+import json
+import time
+import hashlib
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from disk_store import DiskStore, write_atomic
+
+
+class HTTPCache(DiskStore):
+    """Size-bounded on-disk store of HTTP responses.
+
+    Every response is saved as two files: <key>.body with the body and <key>.json with the status, headers and time it
+    was stored. When the bodies take more than max_size bytes, the least recently used entries are evicted.
+
+    """
+
+    def __init__(self, directory='data/http_cache', max_size=64 * 1024 * 1024):
+        # Statistics (besides the ones of every DiskStore)
+        self.revalidations = 0
+        DiskStore.__init__(self, directory, max_size, ('.body', '.json'))
+
+    @staticmethod
+    def get_key(namespace, method, url, body):
+        """Build the key identifying a request. Namespace keeps apart the responses got by different users"""
+
+        key = hashlib.sha1()
+        for part in (namespace, method, url, body or ''):
+            key.update(part if isinstance(part, str) else part.encode('utf-8'))
+            key.update('\0')
+        return key.hexdigest()
+
+    def get(self, key):
+        """Return a (meta, body) pair with the response stored as key, or None if it is not in the cache"""
+
+        if not self.touch(key):
+            return None
+
+        try:
+            with open(self.get_path(key, '.json'), 'r') as f:
+                meta = json.load(f)
+            with open(self.get_path(key, '.body'), 'rb') as f:
+                body = f.read()
+        except (IOError, ValueError):
+            self.remove(key)
+            return None
+
+        return meta, body
+
+    def put(self, key, meta, body):
+        """Store a response as key, evicting the least recently used responses if the cache gets too big"""
+
+        if len(body) > self.max_size:
+            return
+
+        write_atomic(self.get_path(key, '.body'), body)
+        write_atomic(self.get_path(key, '.json'), json.dumps(meta))
+        self.add(key, len(body))
+
+    def touch_meta(self, key, meta):
+        """Update the metadata of a response which has been revalidated by the server"""
+
+        write_atomic(self.get_path(key, '.json'), json.dumps(meta))
+
+    def stats(self):
+        stats = DiskStore.stats(self)
+        stats['revalidations'] = self.revalidations
+        return stats
+
+
+class CachingAdapter(BaseAdapter):
+    """Transport adapter which serves GET requests from an HTTPCache, falling back to another adapter.
+
+    A cached response is returned without contacting the server while it is younger than the TTL of its URL (given by
+    the first (regex, seconds) pair of ttl_rules whose regex matches the URL). Afterwards, it is revalidated with a
+    conditional GET (If-None-Match/If-Modified-Since) and, if the server answers 304 Not Modified, the cached body is
+    returned as if it had been downloaded again.
+
+    """
+
+    def __init__(self, cache, adapter=None, namespace='', ttl_rules=()):
+        BaseAdapter.__init__(self)
+        self.cache = cache
+        self.adapter = adapter if adapter is not None else HTTPAdapter()
+        self.namespace = namespace
+        self.ttl_rules = [(re.compile(regex), ttl) for regex, ttl in ttl_rules]
+
+    def get_ttl(self, url):
+        for regex, ttl in self.ttl_rules:
+            if regex.search(url):
+                return ttl
+        return 0
+
+    def build_response(self, request, meta, body):
+        """Build a response from a cached one"""
+
+        resp = requests.Response()
+        resp.status_code = meta['status_code']
+        resp.headers = CaseInsensitiveDict(meta['headers'])
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        resp.reason = 'OK'
+        resp._content = body
+        resp._content_consumed = True
+        resp.from_cache = True
+        return resp
+
+    def send(self, request, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return self.adapter.send(request, **kwargs)
+
+        key = self.cache.get_key(self.namespace, request.method, request.url, request.body)
+        entry = self.cache.get(key)
+        if entry is not None:
+            meta, body = entry
+            if time.time() - meta['stored'] < self.get_ttl(request.url):
+                self.cache.count('hits')
+                return self.build_response(request, meta, body)
+
+            # Ask the server whether the cached response is still valid
+            headers = CaseInsensitiveDict(meta['headers'])
+            if 'ETag' in headers:
+                request.headers['If-None-Match'] = headers['ETag']
+            if 'Last-Modified' in headers:
+                request.headers['If-Modified-Since'] = headers['Last-Modified']
+
+        resp = self.adapter.send(request, **kwargs)
+
+        if entry is not None and resp.status_code == 304:
+            self.cache.count('hits', 'revalidations')
+            meta['stored'] = time.time()
+            self.cache.touch_meta(key, meta)
+            # Keep the 304 response (it may set cookies) but give it the cached body. Its own (empty) body is read
+            # first, which gives its connection back
+            resp.raw.read()
+            resp.status_code = meta['status_code']
+            resp.reason = 'OK'
+            for name, value in meta['headers'].items():
+                resp.headers.setdefault(name, value)
+            resp.headers['Content-Length'] = str(len(body))
+            resp._content = body
+            resp._content_consumed = True
+            resp.from_cache = True
+            return resp
+
+        self.cache.count('misses')
+        if resp.status_code == 200 and \
+           ('ETag' in resp.headers or 'Last-Modified' in resp.headers or self.get_ttl(request.url) > 0):
+            headers = dict((name, value) for name, value in resp.headers.items()
+                           if name.lower() not in ('set-cookie', 'content-encoding', 'transfer-encoding'))
+            self.cache.put(key, {'status_code': resp.status_code, 'headers': headers, 'stored': time.time()},
+                           resp.content)
+
+        return resp
+
+    def close(self):
+        self.adapter.close()
@@ -9,18 +9,39 @@ This module contains the class implementing the crawler for Mercadona.
 """
 
 import re
-import requests
-import lxml.html
+
+from lxml.etree import XPath
 
 from shop import Shop
 from product import Product
+from extract import RowExtractor, parse_price
+from steps import StepGraph
 
 
 class Mercadona(Shop):
     """Mercadona crawler"""
 
-    def __init__(self, username, password, list_name, debug=False, verbose=False, fake=False):
-        Shop.__init__(self, debug=debug, verbose=verbose, fake=fake)
+    product_list_marker = 'tablaproductos'
+    catalog_url = 'https://www.mercadona.es/ns/seccion.php'
+    catalog_link_xpath = XPath("//a[contains(@href, 'seccion.php?')]/@href")
+    # The index of shopping lists rarely changes
+    http_cache_ttl = ((r'/sfprincipal\.php\?', 3600),)
+
+    # XPath expressions used to find the product list, compiled once
+    list_link_xpath = XPath("//table[@id='tblListas']//a[text()=$list_name]/@href")
+    product_rows_xpath = XPath("//table[@class='tablaproductos']/tbody/tr")
+    # Start tag of the table holding the products, the only fragment of the page parsed
+    product_table_re = re.compile(r'<table\b[^>]*\bclass="tablaproductos"')
+    # Fields of the product rows
+    row_extractor = RowExtractor(
+        unavailable="./td[1]/img[@alt='PRODUCTOS NO DISPONIBLES']/@alt",
+        id="./td[4]/input/@value",
+        name="./td[1]//label",
+        price="./td[2]/span",
+        unitary_price="./td[2]/span[contains(concat(' ', normalize-space(@class), ' '), ' precio_ud ')]")
+
+    def __init__(self, username, password, list_name, debug=False, verbose=False, fake=False, base_url=None):
+        Shop.__init__(self, debug=debug, verbose=verbose, fake=fake, base_url=base_url)
         # Credentials to access to the shop
         self.username = username
         self.password = password
@@ -61,81 +82,94 @@ class Mercadona(Shop):
 
         return round(round(unitary_price, 4), 2), unit  # TODO: Warning!!! floats are not precise
 
-    def get_product_list_page(self):
-        """Get the HTML page which has the product list"""
-
-        session = requests.session()
-
-        resp = session.get('https://www.mercadona.es/ns/entrada.php?js=-1')
-        self.log(resp)
-
-        form_params = {'AyudaPassword': '',
-                       'EntradaUsername': '1',
-                       'ImgEntradaAut': 'ENTRAR',
-                       'Localidad': '',
-                       'Pais': '34',
-                       'Provincia': '',
-                       'TiendaVisita': '1',
-                       'form_origen': 'principal',
-                       'pag_origen': 'entrada.php',
-                       'password': self.password,
-                       'username': self.username}
-        resp = session.post('https://www.mercadona.es/ns/entrada.php', data=form_params)
-        self.log(resp)
+    def login(self, session):
+        """Log in the shop server using session"""
+
+        def get_login_page(results):
+            resp = session.get('https://www.mercadona.es/ns/entrada.php?js=-1')
+            self.log(resp)
+
+        def post_credentials(results):
+            form_params = {'AyudaPassword': '',
+                           'EntradaUsername': '1',
+                           'ImgEntradaAut': 'ENTRAR',
+                           'Localidad': '',
+                           'Pais': '34',
+                           'Provincia': '',
+                           'TiendaVisita': '1',
+                           'form_origen': 'principal',
+                           'pag_origen': 'entrada.php',
+                           'password': self.password,
+                           'username': self.username}
+            resp = session.post('https://www.mercadona.es/ns/entrada.php', data=form_params)
+            self.log(resp)
+
+        steps = StepGraph(session)
+        steps.add('login_page', get_login_page)
+        steps.add('credentials', post_credentials, depends=('login_page',))
+        self.run_steps(steps)
+
+    def find_product_list_url(self, session):
+        """Find the URL of the product list page, once logged in"""
 
         resp = session.get('https://www.mercadona.es/sfprincipal.php?'
                            'page=&id_padre=&id_seccion=&id_lista=&ind=&busc_ref=&busc_marca=&pedido=&tab=1')
         self.log(resp)
-        html_tree = lxml.html.fromstring(resp.text, parser=lxml.html.HTMLParser(encoding='utf-8'))
+        html_tree = self.parse_html(resp.content)
         try:
-            url = html_tree.xpath("//table[@id='tblListas']//a[text()='" + self.list_name + "']")[0].attrib['href']
+            url = self.list_link_xpath(html_tree, list_name=self.list_name)[0]
         except:
             raise ValueError('List name "' + self.list_name + '" not found')
 
-        resp = session.get('https://www.mercadona.es/' + url)
-        self.log(resp)
+        return 'https://www.mercadona.es/' + url
+
+    def find_product_rows(self, html_tree):
+        """Find the elements holding the products in the product list page"""
 
-        return resp.text
+        return self.product_rows_xpath(html_tree)
 
-    def parse_product_list_page(self, html_page):
-        """Parse the HTML page which has the product list and populate the product_dict"""
+    def is_product_row(self, element):
+        """Check whether element holds a product (used when the page is parsed as a stream)"""
 
-        html_tree = lxml.html.fromstring(html_page, parser=lxml.html.HTMLParser(encoding='utf-8'))
+        tbody = element.getparent()
+        if tbody is None or tbody.tag != 'tbody':
+            return False
+        table = tbody.getparent()
+        return table is not None and table.tag == 'table' and table.get('class') == 'tablaproductos'
 
-        product_list = html_tree.xpath("//table[@class='tablaproductos']/tbody/tr")
-        #print len(product_list)
+    def parse_product_row(self, product_item, context):
+        """Parse an element holding a product and add the product to product_dict"""
 
-        for product_item in product_list:
-            # Check whether the product is available
-            if len(product_item.xpath("./td[1]/img[@alt='PRODUCTOS NO DISPONIBLES']")) > 0:
-                continue
+        fields = self.row_extractor.extract(product_item)
 
-            product_id = product_item.xpath("./td[4]/input/@value")[0].partition(';')[0]
+        # Check whether the product is available
+        if 'unavailable' in fields:
+            return
 
-            product_name = product_item.xpath("./td[1]//label")[0].text.replace(' ***LE RECOMENDAMOS***', '')
-            product_name = product_name.encode('utf-8')
+        product_id = fields['id'].partition(';')[0].encode('utf-8')
 
-            product_price = float(product_item.xpath("./td[2]/span")[0].text.partition(' ')[0].replace(',', '.'))
+        product_name = fields['name'].replace(' ***LE RECOMENDAMOS***', '')
+        product_name = product_name.encode('utf-8')
 
-            product_unitary_price = product_item.xpath("./td[2]/span[contains("
-                                                       "concat(' ', normalize-space(@class), ' '), ' precio_ud ')]")
-            if len(product_unitary_price) > 0:
-                product_unitary_price = product_unitary_price[0].text.partition(': ')
-                product_unit = product_unitary_price[0]
-                product_unitary_price = float(product_unitary_price[2].partition(' ')[0].replace(',', '.'))
+        product_price = parse_price(fields['price'])
 
-                # The following are fixings to normalize shop "bugs"
-                if product_id == '43401':
-                    product_unitary_price = product_price
-                    product_unit = '1 UNIDAD'
-                elif product_id == '40805':
-                    amount = re.search(r'(\d+) LAVADOS', product_name).group(1)
-                    product_unitary_price = round(round(product_price / float(amount), 4), 2)
-                    product_unit = '1 LAVADO'
+        if 'unitary_price' in fields:
+            product_unitary_price = fields['unitary_price'].partition(': ')
+            product_unit = product_unitary_price[0]
+            product_unitary_price = parse_price(product_unitary_price[2])
 
-                product_unitary_price, product_unit = self.normalize_unitary_price(product_unitary_price, product_unit)
-            else:
-                product_unitary_price, product_unit = self.get_unitary_price(product_price, product_name)
+            # The following are fixings to normalize shop "bugs"
+            if product_id == '43401':
+                product_unitary_price = product_price
+                product_unit = '1 UNIDAD'
+            elif product_id == '40805':
+                amount = re.search(r'(\d+) LAVADOS', product_name).group(1)
+                product_unitary_price = round(round(product_price / float(amount), 4), 2)
+                product_unit = '1 LAVADO'
+
+            product_unitary_price, product_unit = self.normalize_unitary_price(product_unitary_price, product_unit)
+        else:
+            product_unitary_price, product_unit = self.get_unitary_price(product_price, product_name)
 
-            Shop.add_product(self,
-                             Product(product_id, product_name, product_price, product_unitary_price, product_unit))
+        Shop.add_product(self,
+                         Product(product_id, product_name, product_price, product_unitary_price, product_unit))
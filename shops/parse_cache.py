@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.parse_cache
+~~~~~~~~~~~~~~~~~
+
+This module contains an on-disk cache of the products parsed from the product list pages, so a page which did not
+change is not parsed again.
+
+"""
+
+import json
+import hashlib
+
+from product import Product
+from disk_store import DiskStore, write_atomic
+
+
+class ParseCache(DiskStore):
+    """Size-bounded on-disk store of the products parsed from pages, by hash of the page and version of the parser.
+
+    The products of every page are saved as a json file, <key>.json. When the files take more than max_size bytes, the
+    least recently used entries are evicted.
+
+    """
+
+    def __init__(self, directory='data/parse_cache', max_size=16 * 1024 * 1024):
+        DiskStore.__init__(self, directory, max_size, ('.json',))
+
+    @staticmethod
+    def get_key(page, parser_version):
+        """Build the key identifying the products of page (bytes) parsed by the given version of the parser"""
+
+        key = hashlib.sha1(page)
+        key.update('\0' + parser_version)
+        return key.hexdigest()
+
+    def get(self, key):
+        """Return the list of products stored as key, or None if it is not in the cache"""
+
+        if not self.touch(key):
+            self.count('misses')
+            return None
+
+        try:
+            with open(self.get_path(key, '.json'), 'r') as f:
+                products = [Product.from_dict(product) for product in json.load(f)]
+        except (IOError, ValueError, KeyError):
+            self.remove(key)
+            self.count('misses')
+            return None
+
+        self.count('hits')
+        return products
+
+    def put(self, key, products):
+        """Store a list of products as key, evicting the least recently used entries if the cache gets too big"""
+
+        # The same page (and so key) may be parsed for several users at the same time
+        if key in self:
+            return
+
+        data = json.dumps([product.to_dict() for product in products])
+        if len(data) > self.max_size:
+            return
+
+        write_atomic(self.get_path(key, '.json'), data)
+        self.add(key, len(data))
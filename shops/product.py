@@ -19,6 +19,25 @@ class Product(object):
         self.unitary_price = unitary_price
         self.unit = unit
 
+    def to_dict(self):
+        """Get the product as a dictionary, to be serialized"""
+
+        return {'id': self.id,
+                'name': self.name,
+                'price': self.price,
+                'unitary_price': self.unitary_price,
+                'unit': self.unit}
+
+    @classmethod
+    def from_dict(cls, product_dict):
+        """Build a product from a dictionary got with to_dict() (strings are turned back into utf-8 bytes)"""
+
+        def encode(value):
+            return value.encode('utf-8') if isinstance(value, unicode) else value
+
+        return cls(encode(product_dict['id']), encode(product_dict['name']), product_dict['price'],
+                   product_dict['unitary_price'], encode(product_dict['unit']))
+
     def __str__(self):
         output = self.id + " - " + self.name
 
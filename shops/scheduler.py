@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.scheduler
+~~~~~~~~~~~~~~~
+
+This module contains the scheduler which runs the crawls periodically in daemon mode.
+
+"""
+
+import sys
+import time
+import sched
+import random
+import traceback
+
+
+class CrawlScheduler(object):
+    """Scheduler calling every task once per interval (in seconds), forever.
+
+    The first calls of the tasks are spread evenly over the interval, so the requests of different tasks do not come in
+    bursts, and every call is moved by a random jitter (up to jitter seconds, earlier or later) so they do not come at
+    exact times either. The jitter is applied to the nominal times, so the schedule does not drift.
+
+    """
+
+    def __init__(self, interval, jitter=0.0, timefunc=time.time, delayfunc=time.sleep, seed=None):
+        self.interval = interval
+        self.jitter = jitter
+        self.timefunc = timefunc
+        self.scheduler = sched.scheduler(timefunc, delayfunc)
+        self.random = random.Random(seed)
+        # Tasks to be run: list of (function, arguments)
+        self.tasks = []
+        # Time of the first call of the tasks added with add_at(), by position in tasks
+        self.first_due = {}
+
+    def add(self, func, *args):
+        """Add a task calling func(*args)"""
+
+        self.tasks.append((func, args))
+
+    def add_at(self, due, func, *args):
+        """Add a task calling func(*args), first at time due instead of spread over the interval with the rest"""
+
+        self.first_due[len(self.tasks)] = due
+        self.tasks.append((func, args))
+
+    def run(self):
+        """Run the tasks until interrupted"""
+
+        start = self.timefunc()
+        spread_tasks = [task for i, task in enumerate(self.tasks) if i not in self.first_due]
+        for i, task in enumerate(spread_tasks):
+            self.schedule(task, start + i * self.interval / len(spread_tasks))
+        for i, due in self.first_due.items():
+            self.schedule(self.tasks[i], due)
+        self.scheduler.run()
+
+    def schedule(self, task, due):
+        """Schedule the call of task nominally due at time due"""
+
+        when = due + self.random.uniform(-self.jitter, self.jitter)
+        self.scheduler.enterabs(max(when, self.timefunc()), 0, self.run_task, (task, due))
+
+    def run_task(self, task, due):
+        func, args = task
+        try:
+            func(*args)
+        except Exception:
+            # A failed call must not stop the daemon
+            traceback.print_exc(file=sys.stderr)
+
+        # Skip the calls which should have been done while this one was running
+        due += self.interval
+        while due < self.timefunc():
+            due += self.interval
+        self.schedule(task, due)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.session
+~~~~~~~~~~~~~
+
+This module contains the HTTP session used by the shop crawlers.
+
+"""
+
+import sys
+import time
+import urlparse
+import threading
+
+import requests
+
+
+class Task(threading.Thread):
+    """Function call running in its own thread, whose result is got with get()"""
+
+    def __init__(self, func, args, kwargs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def get(self):
+        """Wait for the call to finish and return its result (or raise its exception)"""
+
+        self.join()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class Session(requests.Session):
+    """HTTP session used by the shop crawlers.
+
+    When base_url is set, the scheme and host of every requested URL are replaced by the ones in base_url, so the
+    crawlers can be run against a local stand-in of the shop servers.
+
+    """
+
+    def __init__(self, base_url=None):
+        requests.Session.__init__(self)
+        self.base_url = base_url
+        # URLs of the product lists found with this session, by list name (saved along with the session cookies)
+        self.product_list_urls = {}
+        # Tracer recording the requests of the session (None means no tracing), and name of the shop to record them
+        self.tracer = None
+        self.shop_name = None
+
+    def rewrite_url(self, url):
+        """Point url to base_url, if any"""
+
+        if not self.base_url:
+            return url
+
+        base = urlparse.urlsplit(self.base_url)
+        parts = urlparse.urlsplit(url)
+        return urlparse.urlunsplit((base.scheme, base.netloc, parts.path, parts.query, parts.fragment))
+
+    def request(self, method, url, *args, **kwargs):
+        url = self.rewrite_url(url)
+        if self.tracer is None:
+            return requests.Session.request(self, method, url, *args, **kwargs)
+
+        start = time.time()
+        try:
+            resp = requests.Session.request(self, method, url, *args, **kwargs)
+        except Exception as e:
+            self.tracer.trace_error(self.shop_name, method, url, start, e)
+            raise
+        self.tracer.trace_response(self.shop_name, method, url, start, resp)
+        return resp
+
+    def spawn(self, func, *args, **kwargs):
+        """Call func in a new thread, to issue requests concurrently. Return the Task running it"""
+
+        task = Task(func, args, kwargs)
+        task.start()
+        return task
+
+    def sleep(self, seconds):
+        """Wait for some seconds, letting the tasks spawned go on"""
+
+        time.sleep(seconds)
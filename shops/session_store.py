@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.session_store
+~~~~~~~~~~~~~~~~~~~
+
+This module contains the store which keeps authenticated sessions between runs.
+
+"""
+
+import os
+import json
+import time
+import hashlib
+
+from requests.cookies import create_cookie
+
+from disk_store import write_atomic
+
+
+class SessionStore(object):
+    """Store of the cookies and login tokens of every pair shop/user, saved as a json file per pair.
+
+    Session files contain credentials (the session cookies), so they are only readable by the owner.
+
+    """
+
+    def __init__(self, directory='data/sessions', max_age=None):
+        self.directory = directory
+        # Sessions older than max_age seconds are discarded without trying them (None means no limit)
+        self.max_age = max_age
+
+    def get_filename(self, shop):
+        """Get the file storing the session of the shop user (the username is hashed to not disclose it)"""
+
+        return os.path.join(self.directory,
+                            shop.__class__.__name__ + '_' + hashlib.sha1(shop.username).hexdigest()[:16] + '.json')
+
+    def load(self, shop, session):
+        """Restore the saved cookies into session and return the saved login tokens, or None if there is no session"""
+
+        try:
+            with open(self.get_filename(shop), 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if self.max_age is not None and time.time() - state['saved'] > self.max_age:
+            return None
+
+        for cookie in state['cookies']:
+            session.cookies.set_cookie(create_cookie(**cookie))
+
+        return state['tokens']
+
+    def save(self, shop, session, tokens):
+        """Save the cookies of session and the login tokens"""
+
+        cookies = [{'name': cookie.name,
+                    'value': cookie.value,
+                    'domain': cookie.domain,
+                    'path': cookie.path,
+                    'secure': cookie.secure,
+                    'expires': cookie.expires} for cookie in session.cookies]
+        state = {'saved': time.time(),
+                 'cookies': cookies,
+                 'tokens': tokens}
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0700)
+
+        write_atomic(self.get_filename(shop), json.dumps(state), 0600)
+
+    def delete(self, shop):
+        """Forget the session of the shop user"""
+
+        try:
+            os.remove(self.get_filename(shop))
+        except OSError:
+            pass
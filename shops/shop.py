@@ -8,17 +8,98 @@ This module contains the base class to be extended by classes implementing speci
 
 """
 
+import os
+import re
 import abc
 import csv
+import hashlib
+import inspect
+import logging
+import urlparse
 from datetime import datetime
 
+import lxml.etree
+import lxml.html
+
+from session import Session
+from http_cache import CachingAdapter
+from tracing import TracingAdapter
+from connection_pool import get_default_pool
+from frontier import Frontier, HostThrottle
+from snapshot import get_shop_key
+
+logger = logging.getLogger(__name__)
+
+
+# Name of the element of a start tag
+TAG_NAME_RE = re.compile(r'<([\w-]+)')
+
+# Versions of the parsers of the shop classes, by class (see Shop.get_parser_version)
+PARSER_VERSIONS = {}
+
+
+class PageStream(object):
+    """Iterator over the chunks of a page which is being downloaded, able to look ahead for some text"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = []
+
+    def find(self, text):
+        """Read chunks until text is found (return True) or the page ends (return False).
+
+        The chunks read are kept, so they are still got when iterating over the page.
+
+        """
+
+        data = ''.join(self.buffer)
+        if text in data:
+            return True
+
+        tail = data[-len(text):]
+        for chunk in self.chunks:
+            self.buffer.append(chunk)
+            if text in tail + chunk:
+                return True
+            tail = (tail + chunk)[-len(text):]
+
+        return False
+
+    def __iter__(self):
+        while self.buffer:
+            yield self.buffer.pop(0)
+        for chunk in self.chunks:
+            yield chunk
+
 
 class Shop(object):
     """Base Class for shop crawlers"""
 
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, name=None, debug=False, verbose=False, fake=False):
+    # Text which is only found in the product list page (used to check whether a saved session is still valid)
+    product_list_marker = None
+    # Character encoding of the pages of the shop
+    encoding = 'utf-8'
+    # Tag of the elements holding the products in the product list page
+    product_row_tag = 'tr'
+    # Compiled regex (over the bytes of the page) of the start tag of the element holding all the products in the
+    # product list page, so only that fragment of the page is parsed (None means the whole page is always parsed)
+    product_table_re = None
+    # Size of the chunks in which the product list page is read when it is parsed as a stream
+    stream_chunk_size = 16 * 1024
+    # Pairs (URL regex, seconds) telling how long cached pages can be used without revalidating them with the server
+    http_cache_ttl = ()
+    # Page where the crawl of the whole catalog starts
+    catalog_url = None
+    # Compiled XPath (lxml.etree.XPath) of the links to be followed when crawling the whole catalog (categories,
+    # subcategories and next pages)
+    catalog_link_xpath = None
+    # Modules of this package (besides the ones of the shop class and its bases) with code used to parse the product
+    # list page, so the products cached from it are dropped when their code changes
+    parser_modules = ('extract', 'product')
+
+    def __init__(self, name=None, debug=False, verbose=False, fake=False, base_url=None):
         # Shop's name
         self.name = name
         if not self.name:
@@ -29,49 +110,470 @@ class Shop(object):
         self.verbose = verbose
         # Product's list is got from a local file, instead of the shop server (Used to speed up debugging)
         self.fake = fake
+        # Parse the product list page while it is downloaded, instead of waiting for the whole page
+        self.stream = False
+        # Parse only the fragment of the product list page holding the products (see product_table_re)
+        self.fragment = True
+        # Crawl the whole catalog of the shop instead of the product list
+        self.catalog = False
+        # Number of pages of the catalog downloaded at the same time
+        self.catalog_workers = 4
+        # Minimum seconds between two requests to the same host when crawling the catalog
+        self.catalog_delay = 0.25
+        # Maximum number of URLs of the catalog kept in memory (the rest wait in a temporary file)
+        self.catalog_frontier_size = 1000
+        # Checkpoint where the progress of the crawl is recorded, so it can be resumed (None means no checkpoint)
+        self.checkpoint = None
+        # URL of a local stand-in of the shop server, to be used instead of the real one
+        self.base_url = base_url
+        # Class of the HTTP sessions used to talk to the shop server
+        self.session_class = Session
+        # Store where the authenticated sessions are kept between runs (None means log in on every run)
+        self.session_store = None
+        # HTTP cache used by the sessions (None means no cache)
+        self.http_cache = None
+        # Store where the product list pages are captured, and replayed from in fake mode (None means no capture)
+        self.fixture_store = None
+        # Time of the captured page replayed in fake mode (None means the last one)
+        self.replay_at = None
+        # Cache of the products parsed from the product list pages (None means the pages are always parsed)
+        self.parse_cache = None
+        # Tracer recording the requests of the sessions (None means no tracing)
+        self.tracer = None
+        # Pool of connections used by the sessions (None means the pool shared by all the shops)
+        self.connection_pool = None
+        # Session used to get the product list page, logged in (it can be shared with the crawlers of other lists of
+        # the same user)
+        self.session = None
+        # Timings of the login steps: list of (step name, start, duration)
+        self.step_timings = []
+        # Time when the products were crawled, if they come from a previous run because this one failed or was late
+        self.stale_since = None
         self.product_dict = {}
 
+    def new_session(self):
+        """Create a new HTTP session to talk to the shop server"""
+
+        session = self.session_class(base_url=self.base_url)
+        pool = self.connection_pool if self.connection_pool is not None else get_default_pool()
+        adapter = None
+        if self.http_cache is not None:
+            adapter = CachingAdapter(self.http_cache,
+                                     adapter=pool.adapter,
+                                     namespace=self.name + '/' + getattr(self, 'username', ''),
+                                     ttl_rules=self.http_cache_ttl)
+        if self.tracer is not None:
+            adapter = TracingAdapter(adapter if adapter is not None else pool.adapter)
+            session.tracer = self.tracer
+            session.shop_name = self.name
+        pool.mount(session, adapter)
+        return session
+
     def log(self, resp):
-        """Print resp content"""
+        """Log resp at debug level (only for debugging: use a Tracer to record the requests)"""
 
-        if self.verbose:
-            print 'Status Code: ', resp.status_code
-            #print '       Body: ', resp.text
-            print '    History: ', resp.history
-            print '   Last URL: ', resp.url
-            print '    Cookies: ', resp.cookies
+        logger.debug('%s: status code %s, history %s, last URL %s, cookies %s',
+                     self.name, resp.status_code, resp.history, resp.url, resp.cookies)
 
     @abc.abstractmethod
-    def get_product_list_page(self):
-        """Abstract method to get the HTML page which has the product list"""
+    def login(self, session):
+        """Abstract method to log in the shop server using session"""
         pass
 
     @abc.abstractmethod
-    def parse_product_list_page(self, html_page):
-        """Abstract method to parse the HTML page which has the product list and populate the product_dict"""
+    def find_product_list_url(self, session):
+        """Abstract method to find the URL of the product list page, once logged in"""
+        pass
+
+    def run_steps(self, steps):
+        """Run a StepGraph, keeping the timings of its steps, and return its results"""
+
+        try:
+            return steps.run()
+        finally:
+            self.step_timings = steps.timings
+            if self.verbose:
+                for name, start, duration in sorted(steps.timings, key=lambda timing: timing[1]):
+                    print '       Step: ', '{0:<16} start {1:7.3f} s, took {2:7.3f} s'.format(name, start, duration)
+
+    def parse_html(self, page):
+        """Parse an HTML page, given as bytes in the encoding of the shop"""
+
+        return lxml.html.fromstring(page, parser=lxml.html.HTMLParser(encoding=self.encoding))
+
+    def is_logged_in(self, resp, page):
+        """Check whether page (got from resp) is the product list page or the session was rejected by the server"""
+
+        if resp.status_code != 200:
+            return False
+
+        if isinstance(page, PageStream):
+            return page.find(self.product_list_marker)
+        return self.product_list_marker in page
+
+    def read_page(self, resp, stream):
+        """Get the raw bytes of the page from resp, as a whole or as a stream of chunks.
+
+        The bytes are given straight to the parser, which decodes them with the encoding of the shop, so the charset
+        detection and decoding done by resp.text are avoided.
+
+        """
+
+        if stream:
+            return PageStream(resp.iter_content(self.stream_chunk_size))
+        return resp.content
+
+    def fetch_product_list_page(self, session, url, stream=False):
+        """Get the product list page at url, or None if the server rejected the session"""
+
+        resp = session.get(url, stream=stream)
+        self.log(resp)
+        page = self.read_page(resp, stream)
+        return page if self.is_logged_in(resp, page) else None
+
+    def get_product_list_page(self, stream=False, session=None):
+        """Get the bytes of the HTML page which has the product list (a PageStream if stream is set).
+
+        If there is a session saved from a previous run, it is used to go straight to the product list page, logging
+        in again only if the server rejects it. A session logged in by the crawler of another list of the same user
+        can be given instead, so the login is skipped too. The session used is kept in self.session.
+
+        """
+
+        list_name = getattr(self, 'list_name', None)
+
+        logged_in = session is not None
+        if session is None:
+            session = self.new_session()
+            if self.session_store is not None:
+                tokens = self.session_store.load(self, session)
+                if tokens is not None:
+                    session.product_list_urls = tokens.get('product_list_urls', {})
+
+        url = session.product_list_urls.get(list_name)
+        if url is not None:
+            page = self.fetch_product_list_page(session, url, stream)
+            if page is not None:
+                self.session = session
+                return page
+            logged_in = False
+
+        if not logged_in:
+            if self.session_store is not None:
+                self.session_store.delete(self)
+            product_list_urls = session.product_list_urls
+            session = self.new_session()
+            session.product_list_urls = dict(product_list_urls)
+            self.login(session)
+
+        url = self.find_product_list_url(session)
+        resp = session.get(url, stream=stream)
+        self.log(resp)
+
+        self.session = session
+        session.product_list_urls[list_name] = url
+        if self.session_store is not None:
+            self.session_store.save(self, session, {'product_list_urls': session.product_list_urls})
+
+        return self.read_page(resp, stream)
+
+    @abc.abstractmethod
+    def find_product_rows(self, html_tree):
+        """Abstract method to find the elements holding the products in the product list page"""
+        pass
+
+    @abc.abstractmethod
+    def is_product_row(self, element):
+        """Abstract method to check whether element (a product_row_tag element) holds a product.
+
+        Used when the page is parsed as a stream, so only element, its attributes and its ancestors can be checked.
+
+        """
         pass
 
-    def gather_products(self):
-        """Do the crawling and fill the product list"""
+    @abc.abstractmethod
+    def parse_product_row(self, product_item, context):
+        """Abstract method to parse an element holding a product and add the product to product_dict.
+
+        Context is a dictionary shared by all the rows of the page, where state can be kept from row to row.
+
+        """
+        pass
+
+    def find_product_table(self, html_page):
+        """Find the fragment of the product list page holding the products: the element whose start tag matches
+        product_table_re, up to its end tag. Return None if it is not found"""
+
+        if self.product_table_re is None:
+            return None
+
+        match = self.product_table_re.search(html_page)
+        if match is None:
+            return None
+
+        # Find the end tag, skipping the elements of the same tag nested in it. The tags are matched in both cases
+        # letter by letter, as re.IGNORECASE makes the scan several times slower
+        tag = TAG_NAME_RE.match(match.group(0)).group(1)
+        tags_re = re.compile(r'<(/?)' + ''.join('[{0}{1}]'.format(c.lower(), c.upper()) for c in tag) + r'\b')
+        depth = 0
+        for tag_match in tags_re.finditer(html_page, match.start()):
+            depth += -1 if tag_match.group(1) else 1
+            if depth == 0:
+                end = html_page.find('>', tag_match.end())
+                if end == -1:
+                    return None
+                return html_page[match.start():end + 1]
+        return None
+
+    def parse_product_list_page(self, html_page):
+        """Parse the HTML page which has the product list and populate the product_dict.
+
+        In fragment mode, only the element holding the products is parsed. The whole page is parsed if it is not
+        found or it has no products.
+
+        """
+
+        product_rows = None
+        if self.fragment:
+            fragment = self.find_product_table(html_page)
+            if fragment is not None:
+                product_rows = self.find_product_rows(self.parse_html(fragment))
+
+        if not product_rows:
+            product_rows = self.find_product_rows(self.parse_html(html_page))
+
+        context = {}
+        for product_item in product_rows:
+            self.parse_product_row(product_item, context)
+
+    def parse_product_list_stream(self, chunks):
+        """Parse the HTML page which has the product list while it is being read, chunk by chunk.
+
+        Every product is parsed as soon as its element is complete, and the element is dropped afterwards, so neither
+        the whole page nor its whole tree are kept in memory.
+
+        """
+
+        parser = lxml.etree.HTMLPullParser(events=('end',), tag=self.product_row_tag, encoding=self.encoding)
+        parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+
+        context = {}
+        for chunk in chunks:
+            parser.feed(chunk)
+            self._parse_product_row_events(parser.read_events(), context)
+        parser.close()
+        self._parse_product_row_events(parser.read_events(), context)
+
+    def _parse_product_row_events(self, events, context):
+        for _, element in events:
+            if not self.is_product_row(element):
+                continue
+
+            self.parse_product_row(element, context)
+
+            # Free the rows already parsed
+            element.clear()
+            parent = element.getparent()
+            while element.getprevious() is not None:
+                del parent[0]
+
+    def gather_products(self, session=None):
+        """Do the crawling and fill the product list (session is an already logged in session to be reused, if any).
+
+        If there is a checkpoint, the progress is recorded in it, and the products and pages recorded by the previous
+        run are not crawled again when it is resumed.
+
+        """
+
+        self.product_dict = {}
+        if self.checkpoint is None:
+            self._gather_products(session)
+            return
+
+        self.checkpoint.open()
+        try:
+            self.product_dict.update(self.checkpoint.products)
+            if not self.checkpoint.finished:
+                self._gather_products(session)
+                self.checkpoint.finish()
+        finally:
+            self.checkpoint.close()
+
+    def _gather_products(self, session):
+        if self.catalog and not self.fake:
+            self.crawl_catalog(session)
+            return
+
+        if self.stream:
+            if not self.fake:
+                chunks = self.get_product_list_page(stream=True, session=session)
+                if self.fixture_store is not None:
+                    chunks = self.fixture_store.capture_stream(self.__class__.__name__, get_shop_key(self), chunks)
+                self.parse_product_list_stream(chunks)
+            else:
+                self.parse_product_list_stream(self.iter_fake_page())
+            return
 
         if not self.fake:
             # Get the product list HTML page from the server
-            html_page = self.get_product_list_page()
+            html_page = self.get_product_list_page(session=session)
 
-#            # Dump the page to be used later in fake mode
-#            f = open('data/' + self.__class__.__name__ + '_fake_page.html', 'w')
-#            f.write(html_page)
-#            f.close()
+            # Capture the page to be replayed later in fake mode
+            if self.fixture_store is not None:
+                self.fixture_store.capture(self.__class__.__name__, get_shop_key(self), html_page)
         else:
-            # Get the product list HTML page from a previously saved file
-            f = open('data/' + self.__class__.__name__ + '_fake_page.html', 'r')
-            html_page = f.read()
-            f.close()
+            # Get the product list HTML page from a previously captured one
+            html_page = ''.join(self.iter_fake_page())
+
+        if self.parse_cache is None:
+            self.parse_product_list_page(html_page)
+            return
+
+        # Get the products from the cache if the same page was parsed before by the same code
+        key = self.parse_cache.get_key(html_page, self.get_parser_version())
+        products = self.parse_cache.get(key)
+        if products is not None:
+            if self.verbose:
+                print 'Parse cache: ', '{0} products of page {1}'.format(len(products), key)
+            for product in products:
+                self.add_product(product)
+            return
+
+        # Keep apart the products of the page (there may be products recorded by a previous run in a checkpoint)
+        product_dict = self.product_dict
+        self.product_dict = {}
+        try:
+            self.parse_product_list_page(html_page)
+            self.parse_cache.put(key, self.product_dict.values())
+        finally:
+            product_dict.update(self.product_dict)
+            self.product_dict = product_dict
+
+    @classmethod
+    def get_parser_version(cls):
+        """Get the version of the parser of the product list page: a hash of the source code of the modules of the
+        class and its bases and parser_modules"""
+
+        version = PARSER_VERSIONS.get(cls)
+        if version is None:
+            filenames = set(os.path.abspath(inspect.getsourcefile(base)) for base in cls.__mro__ if base is not object)
+            filenames.update(os.path.join(os.path.dirname(os.path.abspath(__file__)), module + '.py')
+                             for module in cls.parser_modules)
+
+            digest = hashlib.sha1(cls.__name__)
+            for filename in sorted(filenames, key=os.path.basename):
+                with open(filename, 'rb') as f:
+                    digest.update('\0' + f.read())
+            version = PARSER_VERSIONS[cls] = digest.hexdigest()
+        return version
+
+    def iter_fake_page(self):
+        """Iterate over the chunks of the product list page used in fake mode.
+
+        The page is the last one captured in the fixture store (at replay_at, if set) or, if there is none, the one
+        saved in the data directory.
+
+        """
+
+        page_hash = None
+        if self.fixture_store is not None:
+            page_hash = self.fixture_store.find(self.__class__.__name__, get_shop_key(self), self.replay_at)
+
+        if page_hash is not None:
+            for chunk in self.fixture_store.iter_page(page_hash):
+                yield chunk
+        else:
+            with open('data/' + self.__class__.__name__ + '_fake_page.html', 'rb') as f:
+                for chunk in iter(lambda: f.read(self.stream_chunk_size), ''):
+                    yield chunk
+
+    def crawl_catalog(self, session=None):
+        """Crawl the whole catalog of the shop, starting from catalog_url, and fill the product list.
+
+        The pages are downloaded by catalog_workers workers from a bounded Frontier, and the links matching
+        catalog_link_xpath are followed. The products of every page are parsed with the same methods than the product
+        list page, and the page is dropped afterwards.
+
+        """
+
+        if session is None:
+            session = self.new_session()
+            self.login(session)
+        self.session = session
+
+        frontier = Frontier(self.catalog_frontier_size)
+        if self.checkpoint is not None and self.checkpoint.urls:
+            # Resume the crawl recorded in the checkpoint: queue again the URLs whose pages were not done
+            for url in self.checkpoint.done:
+                frontier.skip(url)
+            for url in self.checkpoint.urls:
+                frontier.add(url)
+            frontier.checkpoint = self.checkpoint
+        else:
+            frontier.checkpoint = self.checkpoint
+            frontier.add(self.catalog_url)
+        throttle = HostThrottle(self.catalog_delay, sleep=session.sleep)
+
+        workers = [session.spawn(self._crawl_catalog_pages, session, frontier, throttle)
+                   for _ in range(self.catalog_workers)]
+        for worker in workers:
+            worker.get()
+
+        if self.verbose:
+            print '    Catalog: ', '{0} pages ({1} failed), {2} products'.format(frontier.done_count,
+                                                                                 frontier.failed_count,
+                                                                                 len(self.product_dict))
+
+        # Fail instead of leaving an empty catalog (e.g. the login was rejected or the start page failed), so the
+        # products of the last run are used
+        if frontier.done_count > 0 and frontier.failed_count == frontier.done_count:
+            raise ValueError('All the {0} pages of the catalog failed'.format(frontier.done_count))
+        if not self.product_dict:
+            raise ValueError('No products found in the catalog ({0} pages, {1} failed)'.format(
+                frontier.done_count, frontier.failed_count))
+
+    def _crawl_catalog_pages(self, session, frontier, throttle):
+        while True:
+            url = frontier.get()
+            if url is None:
+                return
+
+            failed = True
+            try:
+                throttle.wait(url)
+                resp = session.get(url)
+                self.log(resp)
+                if resp.status_code == 200:
+                    html_tree = self.parse_html(resp.content)
+
+                    context = {}
+                    for product_item in self.find_product_rows(html_tree):
+                        try:
+                            self.parse_product_row(product_item, context)
+                        except (IndexError, KeyError, ValueError, AttributeError):
+                            # Catalogs have rows the crawlers cannot parse (e.g. unknown units): skip them
+                            pass
+
+                    for link in self.catalog_link_xpath(html_tree):
+                        frontier.add(urlparse.urljoin(url, link.strip()))
+                    failed = False
+            except Exception as e:
+                # A page which cannot be downloaded must not stop the crawl (it is counted as failed)
+                if self.verbose:
+                    print '      Error: ', url, e
+            finally:
+                frontier.done(url, failed)
+
+    def gather_products_async(self):
+        """Do the crawling in a new greenlet and return it (requires gevent)"""
 
-        self.parse_product_list_page(html_page)
+        import async_backend
+        return async_backend.gather_products_async(self)
 
     def add_product(self, product):
         self.product_dict[product.id] = product
+        if self.checkpoint is not None:
+            self.checkpoint.product_found(product)
 
         if self.verbose:
             print product
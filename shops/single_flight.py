@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.single_flight
+~~~~~~~~~~~~~~~~~~~
+
+This module contains the merging of identical requests sent at the same time by the sessions of several users.
+
+"""
+
+import copy
+import threading
+
+from requests.adapters import BaseAdapter
+
+
+class Flight(object):
+    """Request being sent on behalf of all the identical requests which wait for it"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.resp = None
+        self.error = None
+
+
+class SingleFlightAdapter(BaseAdapter):
+    """Transport adapter which merges concurrent identical GET requests into a single one sent by another adapter.
+
+    Only requests without cookies (e.g. the public pages of a shop) are merged: the ones of a logged in session are
+    specific to its user, so they are passed on to the other adapter untouched. Requests are identical if their method,
+    URL and headers are the same. The first one is sent and the rest wait for it and get a copy of its response.
+
+    Responses setting cookies are not shared (every session must get cookies of its own), so only the requests to URLs
+    whose last response did not set cookies wait for an identical one: the rest (e.g. the login pages) are sent on
+    their own, learning whether their URL sets cookies. Streamed requests are never merged.
+
+    """
+
+    def __init__(self, adapter):
+        BaseAdapter.__init__(self)
+        self.adapter = adapter
+        self._lock = threading.Lock()
+        self._flights = {}
+        # URLs whose last response did not set cookies
+        self._cookieless_urls = set()
+        # Number of requests which got the response of another one
+        self.merged = 0
+
+    def send(self, request, **kwargs):
+        if request.method not in ('GET', 'HEAD') or kwargs.get('stream') or 'Cookie' in request.headers:
+            return self.adapter.send(request, **kwargs)
+
+        key = (request.method, request.url, tuple(sorted(request.headers.items())))
+        with self._lock:
+            cookieless = request.url in self._cookieless_urls
+            if cookieless:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = Flight()
+
+        if not cookieless:
+            resp = self.adapter.send(request, **kwargs)
+            self._learn(request.url, resp)
+            return resp
+
+        if leader:
+            try:
+                flight.resp = self.adapter.send(request, **kwargs)
+                self._learn(request.url, flight.resp)
+                # Read the body, to be shared
+                flight.resp.content
+                return flight.resp
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.event.set()
+
+        flight.event.wait()
+        if flight.error is not None or 'set-cookie' in flight.resp.headers:
+            return self.adapter.send(request, **kwargs)
+
+        with self._lock:
+            self.merged += 1
+        resp = copy.copy(flight.resp)
+        resp.request = request
+        resp.headers = flight.resp.headers.copy()
+        resp.cookies = flight.resp.cookies.copy()
+        return resp
+
+    def _learn(self, url, resp):
+        """Record whether the response to url set cookies"""
+
+        with self._lock:
+            if 'set-cookie' in resp.headers:
+                self._cookieless_urls.discard(url)
+            else:
+                self._cookieless_urls.add(url)
+
+    def close(self):
+        self.adapter.close()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.snapshot
+~~~~~~~~~~~~~~
+
+This module contains the store which keeps the last products crawled from every shop.
+
+"""
+
+import os
+import json
+import time
+import hashlib
+
+from product import Product
+from disk_store import write_atomic
+
+
+def get_shop_key(shop):
+    """Get a key identifying the shop list of a user or the shop catalog (user and list are hashed to hide them)"""
+
+    if shop.catalog:
+        # The catalog is the same for every user
+        digest = hashlib.sha1('\0catalog').hexdigest()
+    else:
+        digest = hashlib.sha1(getattr(shop, 'username', '') + '\0' + getattr(shop, 'list_name', '')).hexdigest()
+    return shop.__class__.__name__ + '_' + digest[:16]
+
+
+class SnapshotStore(object):
+    """Store of the products crawled from every shopping list, saved as a json file per shop, user and list"""
+
+    def __init__(self, directory='data/snapshots'):
+        self.directory = directory
+
+    def get_filename(self, shop):
+        """Get the file storing the products of the shop list or catalog"""
+
+        return os.path.join(self.directory, get_shop_key(shop) + '.json')
+
+    def save(self, shop):
+        """Save the products of shop"""
+
+        snapshot = {'saved': time.time(),
+                    'products': [product.to_dict() for product in shop.product_dict.values()]}
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        write_atomic(self.get_filename(shop), json.dumps(snapshot))
+
+    def load(self, shop):
+        """Return a pair (time it was saved, product dictionary) with the last products saved for shop, or None"""
+
+        try:
+            with open(self.get_filename(shop), 'r') as f:
+                snapshot = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        products = [Product.from_dict(product) for product in snapshot['products']]
+        return snapshot['saved'], dict((product.id, product) for product in products)
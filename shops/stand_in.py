@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.stand_in
+~~~~~~~~~~~~~~
+
+This module contains a local HTTP server which stands in for the Mercadona, Hipercor and Eroski servers.
+
+It replays the login flows followed by the crawlers (redirects, session cookies and hidden form fields) and serves the
+product list pages from the fake pages in the data directory, so the whole network path can be benchmarked and tested
+offline. Latency, bandwidth and errors can be injected. Point the crawlers to it with the base_url of the shops
+(--base-url in the shoptimizer script):
+
+    python -m shops.stand_in --port 8000 --latency 0.05 --bandwidth 512 --error-rate 0.01
+
+"""
+
+import os
+import sys
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from Cookie import SimpleCookie
+
+
+# Page with the links to the shopping lists of every shop, once logged in
+LIST_INDEX_PAGES = {
+    'Mercadona': '<html><body><table id="tblListas">{links}</table></body></html>',
+    'Hipercor': '<html><body><div id="contenedor_popup_desplegable_mislistas">{links}</div></body></html>',
+    'Eroski': '<html><body><div id="divListas">{links}</div></body></html>',
+}
+# Link to every shopping list in the list index page
+LIST_LINKS = {
+    'Mercadona': '<tr><td><a href="ns/lista.php?id_lista={list_id}">{list_name}</a></td></tr>',
+    'Hipercor': '<a href="hipercor/sm2/wishlist/wishListDetail.jsp?listId={list_id}"><span>{list_name}</span></a>',
+    'Eroski': '<a href="/ecoventa/actions/mostrarListaCompra.do?idLista={list_id}">- {list_name}</a>',
+}
+# Path of the catalog pages of every shop
+CATALOG_PATHS = {
+    'Mercadona': '/ns/seccion.php',
+    'Hipercor': '/hipercor/sm2/catalog/categoryView.jsp',
+    'Eroski': '/ecoventa/actions/mostrarCategoria.do',
+}
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server keeping the configuration and the sessions of the stand-in shops"""
+
+    daemon_threads = True
+
+    def __init__(self, address, data_dir='data', list_name='fake', latency=0.0, bandwidth=None, error_rate=0.0,
+                 seed=None, verbose=False, catalog_categories=5, catalog_pages=4):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandInRequestHandler)
+        self.data_dir = data_dir
+        # Names of the shopping lists of every shop, separated by commas (all of them have the same products)
+        self.list_names = list_name.split(',')
+        # Seconds to wait before answering every request
+        self.latency = latency
+        # Maximum bytes per second sent in every response body (None means no limit)
+        self.bandwidth = bandwidth
+        # Probability of answering a request with a 503 Service Unavailable error
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        # Log every request
+        self.verbose = verbose
+        # Number of categories of the catalog of every shop, and of pages of every category
+        self.catalog_categories = catalog_categories
+        self.catalog_pages = catalog_pages
+
+        self._lock = threading.Lock()
+        # Sessions of every shop: (shop, session id) -> set of completed login steps
+        self.sessions = {}
+        self.pages = {}
+
+    def get_page(self, shop_name):
+        """Get the product list page of a shop, read from its fake page"""
+
+        with self._lock:
+            if shop_name not in self.pages:
+                with open(os.path.join(self.data_dir, shop_name + '_fake_page.html'), 'rb') as f:
+                    self.pages[shop_name] = f.read()
+            return self.pages[shop_name]
+
+    def inject_error(self):
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+    def get_session(self, shop_name, session_id):
+        with self._lock:
+            return self.sessions.get((shop_name, session_id))
+
+    def new_session(self, shop_name):
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self.sessions[(shop_name, session_id)] = set()
+        return session_id
+
+
+class StandInRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handler imitating the pages of every shop used by the crawlers"""
+
+    protocol_version = 'HTTP/1.1'
+
+    # (method, path) -> (shop name, handler method name)
+    routes = {
+        ('GET', '/ns/entrada.php'): ('Mercadona', 'mercadona_login_page'),
+        ('POST', '/ns/entrada.php'): ('Mercadona', 'mercadona_login'),
+        ('GET', '/sfprincipal.php'): ('Mercadona', 'list_index'),
+        ('GET', '/ns/lista.php'): ('Mercadona', 'product_list'),
+        ('GET', '/hiper'): ('Hipercor', 'hipercor_home'),
+        ('GET', '/hipercor/sm2/login/login.jsp'): ('Hipercor', 'hipercor_login_page'),
+        ('GET', '/profile2/profile/auth/TAM/AutenticaUsuario'): ('Hipercor', 'hipercor_tam'),
+        ('POST', '/profile2/profile/LoginServlet'): ('Hipercor', 'hipercor_login'),
+        ('POST', '/pkmslogin.form'): ('Hipercor', 'hipercor_pkmslogin'),
+        ('POST', '/hipercor/sm2/login/login.jsp'): ('Hipercor', 'hipercor_login_options'),
+        ('GET', '/hipercor/sm2/wishlist/wishListView.jsp'): ('Hipercor', 'list_index'),
+        ('GET', '/hipercor/sm2/wishlist/wishListDetail.jsp'): ('Hipercor', 'product_list'),
+        ('GET', '/ecoventa/index.jsp'): ('Eroski', 'eroski_home'),
+        ('POST', '/ecoventa/actions/accesoUsuarioRegistrado.do'): ('Eroski', 'eroski_login'),
+        ('POST', '/ecoventa/actions/seleccionarDireccionEnvio.do'): ('Eroski', 'eroski_select_address'),
+        ('GET', '/ecoventa/actions/mostrarListaHabitualUsuario.do'): ('Eroski', 'list_index'),
+        ('GET', '/ecoventa/actions/mostrarListaCompra.do'): ('Eroski', 'product_list'),
+    }
+    routes.update((('GET', path), (shop_name, 'catalog')) for shop_name, path in CATALOG_PATHS.items())
+
+    # Login page of every shop, where requests with no valid session are redirected
+    login_pages = {
+        'Mercadona': '/ns/entrada.php?js=-1',
+        'Hipercor': '/hipercor/sm2/login/login.jsp',
+        'Eroski': '/ecoventa/index.jsp',
+    }
+
+    # Name of the session cookie of every shop
+    cookie_names = {
+        'Mercadona': 'PHPSESSID',
+        'Hipercor': 'JSESSIONID',
+        'Eroski': 'JSESSIONID',
+    }
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def dispatch(self):
+        self.new_cookies = []
+        url = urlparse.urlsplit(self.path)
+        self.query = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length', 0))
+        self.form = dict(urlparse.parse_qsl(self.rfile.read(length))) if length else {}
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if (self.command, url.path) not in self.routes:
+            return self.respond(404, '<html><body>Not found</body></html>')
+        if self.server.inject_error():
+            return self.respond(503, '<html><body>Service unavailable</body></html>')
+
+        shop_name, handler_name = self.routes[(self.command, url.path)]
+        self.shop_name = shop_name
+
+        # Find the session of the shop, starting a new one if the client has none
+        cookies = SimpleCookie(self.headers.get('Cookie', ''))
+        cookie_name = self.cookie_names[shop_name]
+        self.session_id = cookies[cookie_name].value if cookie_name in cookies else None
+        self.session = self.server.get_session(shop_name, self.session_id)
+        if self.session is None:
+            self.session_id = self.server.new_session(shop_name)
+            self.session = self.server.get_session(shop_name, self.session_id)
+            self.new_cookies.append((cookie_name, self.session_id))
+
+        getattr(self, handler_name)()
+
+    def respond(self, status, body='', headers=()):
+        self.send_response(status)
+        for cookie in self.new_cookies:
+            self.send_header('Set-Cookie', '%s=%s; Path=/' % cookie)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        if self.server.bandwidth:
+            chunk_size = max(1, self.server.bandwidth // 10)
+            for start in xrange(0, len(body), chunk_size):
+                self.wfile.write(body[start:start + chunk_size])
+                self.wfile.flush()
+                time.sleep(0.1)
+        else:
+            self.wfile.write(body)
+
+    def redirect(self, location):
+        self.respond(302, headers=[('Location', location)])
+
+    def form_page(self, **fields):
+        """Build a page with a form holding hidden fields"""
+
+        inputs = ''.join('<input type="hidden" name="%s" value="%s"/>' % item for item in fields.items())
+        return '<html><body><form method="post">' + inputs + '</form></body></html>'
+
+    def login_required(self):
+        """Redirect to the login page if the session has not completed the login. Return whether it did"""
+
+        if 'logged' not in self.session:
+            self.redirect(self.login_pages[self.shop_name])
+            return True
+        return False
+
+    def list_index(self):
+        if self.login_required():
+            return
+        links = ''.join(LIST_LINKS[self.shop_name].format(list_id=list_id, list_name=list_name)
+                        for list_id, list_name in enumerate(self.server.list_names, 1))
+        self.respond(200, LIST_INDEX_PAGES[self.shop_name].format(links=links))
+
+    def product_list(self):
+        if self.login_required():
+            return
+
+        page = self.server.get_page(self.shop_name)
+        etag = '"' + hashlib.sha1(page).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.respond(304, headers=[('ETag', etag)])
+        self.respond(200, page, headers=[('ETag', etag)])
+
+    def catalog(self):
+        """Serve the index of categories, or a page of a category if the category and the page are in the query.
+
+        Category pages have the products of the fake page, and link to the next page and to the first one (which was
+        seen already, so the crawlers must skip it).
+
+        """
+
+        if self.login_required():
+            return
+
+        path = CATALOG_PATHS[self.shop_name]
+        if 'cat' not in self.query:
+            links = ''.join('<a href="{0}?cat={1}&amp;page=1">Category {1}</a>'.format(path, category)
+                            for category in range(1, self.server.catalog_categories + 1))
+            return self.respond(200, '<html><body>' + links + '</body></html>')
+
+        category, page_number = self.query['cat'], int(self.query.get('page', 1))
+        links = '<a href="{0}?cat={1}&amp;page=1">1</a>'.format(path, category)
+        if page_number < self.server.catalog_pages:
+            links += '<a href="{0}?cat={1}&amp;page={2}">Next</a>'.format(path, category, page_number + 1)
+
+        page = self.server.get_page(self.shop_name)
+        end = page.lower().rfind('</body>')
+        if end < 0:
+            end = len(page)
+        self.respond(200, page[:end] + links + page[end:])
+
+    # Mercadona
+
+    def mercadona_login_page(self):
+        self.respond(200, self.form_page(form_origen='principal', pag_origen='entrada.php'))
+
+    def mercadona_login(self):
+        if not self.form.get('username') or not self.form.get('password'):
+            return self.redirect(self.login_pages['Mercadona'])
+        self.session.add('logged')
+        self.respond(200, '<html><body>Bienvenido</body></html>')
+
+    # Hipercor
+
+    def hipercor_home(self):
+        self.respond(200, '<html><body>Hipercor</body></html>')
+
+    def hipercor_login_page(self):
+        self.session.add('dynSessConf')
+        self.respond(200, self.form_page(_dynSessConf=self.session_id[:16]))
+
+    def hipercor_tam(self):
+        self.new_cookies.append(('PD-H-SESSION-ID', self.session_id))
+        # Redirect to the path only, so the client stays in the stand-in server
+        self.redirect(urlparse.urlsplit(self.query.get('urltam', self.login_pages['Hipercor'])).path)
+
+    def hipercor_login(self):
+        if self.form.get('_dynSessConf') != self.session_id[:16]:
+            return self.redirect(self.login_pages['Hipercor'])
+        self.session.add('credentials')
+        self.respond(200, self.form_page(username=self.form.get('Username', ''), password=self.form.get('password', '')))
+
+    def hipercor_pkmslogin(self):
+        if 'credentials' not in self.session:
+            return self.redirect(self.login_pages['Hipercor'])
+        self.session.add('tam')
+        self.respond(200, self.form_page(_dynSessConf=self.session_id[16:32]))
+
+    def hipercor_login_options(self):
+        if 'tam' not in self.session or self.form.get('_dynSessConf') != self.session_id[16:32]:
+            return self.redirect(self.login_pages['Hipercor'])
+        self.session.add('logged')
+        self.redirect('/hiper')
+
+    # Eroski
+
+    def eroski_home(self):
+        self.respond(200, '<html><body>Eroski</body></html>')
+
+    def eroski_login(self):
+        if not self.form.get('shlogid') or not self.form.get('shlpswd'):
+            return self.redirect(self.login_pages['Eroski'])
+        self.session.add('credentials')
+        self.respond(200, '<html><body>Direcciones de envio</body></html>')
+
+    def eroski_select_address(self):
+        if 'credentials' not in self.session:
+            return self.redirect(self.login_pages['Eroski'])
+        self.session.add('logged')
+        self.redirect('/ecoventa/actions/mostrarListaHabitualUsuario.do')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the servers of the supported shops')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--data-dir', default='data', help='directory with the fake pages (default: %(default)s)')
+    parser.add_argument('--list-name', default='fake',
+                        help='names of the shopping lists, separated by commas (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before every response')
+    parser.add_argument('--bandwidth', type=int, default=None, help='maximum bytes per second of every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of answering with an error')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the error injection')
+    parser.add_argument('--catalog-categories', type=int, default=5,
+                        help='number of categories of the catalogs (default: %(default)s)')
+    parser.add_argument('--catalog-pages', type=int, default=4,
+                        help='number of pages of every category of the catalogs (default: %(default)s)')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    server = StandInServer((args.host, args.port), data_dir=args.data_dir, list_name=args.list_name,
+                           latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate, seed=args.seed,
+                           verbose=args.verbose, catalog_categories=args.catalog_categories,
+                           catalog_pages=args.catalog_pages)
+    print 'Stand-in shop server listening on http://%s:%d' % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.steps
+~~~~~~~~~~~
+
+This module contains the graph of steps used to describe the login flows of the shops.
+
+"""
+
+import time
+
+
+class StepGraph(object):
+    """Graph of steps (usually requests) where every step only waits for the steps it depends on.
+
+    Steps are added with add() and run with run(), which issues the steps whose dependencies are done at the same time,
+    using the spawn() method of the session. Every step is a function receiving a dictionary with the results of the
+    steps already done, keyed by step name. The start time (relative to the start of the graph) and the duration of
+    every step are recorded in timings.
+
+    """
+
+    def __init__(self, session):
+        self.session = session
+        # List of (name, function, names of the steps it depends on), in the order they were added
+        self.steps = []
+        # List of (name, start, duration) of every step run
+        self.timings = []
+
+    def add(self, name, func, depends=()):
+        self.steps.append((name, func, tuple(depends)))
+
+    def run(self):
+        """Run all the steps and return a dictionary with their results, keyed by step name"""
+
+        results = {}
+        pending = list(self.steps)
+        start = time.time()
+
+        def timed(name, func):
+            step_start = time.time()
+            try:
+                return func(results)
+            finally:
+                self.timings.append((name, step_start - start, time.time() - step_start))
+
+        while pending:
+            ready = [step for step in pending if all(depend in results for depend in step[2])]
+            if not ready:
+                raise ValueError('Steps with unmet dependencies: ' + ', '.join(step[0] for step in pending))
+
+            if len(ready) == 1:
+                name, func, _ = ready[0]
+                results[name] = timed(name, func)
+            else:
+                tasks = [(name, self.session.spawn(timed, name, func)) for name, func, _ in ready]
+                for name, task in tasks:
+                    results[name] = task.get()
+
+            pending = [step for step in pending if step not in ready]
+
+        return results
+
+    def critical_path(self):
+        """Time from the start of the graph to the end of its last step"""
+
+        return max([step_start + duration for _, step_start, duration in self.timings] or [0.0])
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""
+shops.tracing
+~~~~~~~~~~~~~
+
+This module contains the tracing of the requests sent to the shops.
+
+Every request sent by a traced session is recorded as an event with the time spent in every phase (DNS lookup, TCP
+connect, TLS handshake, time to first byte and download), the bytes received and the redirects followed. The phases are
+measured by connection classes plugged into the connection pools of urllib3 (only new connections have DNS, connect
+and TLS times) and by a TracingAdapter on top of the adapters of the session. Events are put in a queue and written by a
+background thread, as json lines and/or a summary table, so the crawl never waits for them.
+
+"""
+
+import time
+import json
+import Queue
+import socket
+import threading
+
+from requests.adapters import BaseAdapter
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+# Phases of a request, in order
+PHASES = ('dns', 'connect', 'tls', 'ttfb', 'download')
+
+
+class TracingConnectionMixin(object):
+    """Mixin of the urllib3 connections timing the DNS lookup and the TCP connect of new connections.
+
+    The host is resolved before connecting, so only its first address is tried.
+
+    """
+
+    trace_timings = None
+
+    def _new_conn(self):
+        start = time.time()
+        host = self._dns_host
+        try:
+            address = socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)[0][4][0]
+        except socket.error:
+            # Let the connection fail as usual
+            address = host
+        resolved = time.time()
+
+        # _dns_host is only used to open the socket: the Host header and the TLS checks use the original host
+        self._dns_host = address
+        try:
+            conn = super(TracingConnectionMixin, self)._new_conn()
+        finally:
+            self._dns_host = host
+
+        self.trace_timings = {'dns': resolved - start, 'connect': time.time() - resolved}
+        return conn
+
+    def pop_trace_timings(self):
+        """Get the timings of the connection, if it was opened since the last call"""
+
+        timings, self.trace_timings = self.trace_timings, None
+        return timings or {}
+
+
+class TracingHTTPConnection(TracingConnectionMixin, HTTPConnection):
+    pass
+
+
+class TracingHTTPSConnection(TracingConnectionMixin, HTTPSConnection):
+
+    def connect(self):
+        start = time.time()
+        HTTPSConnection.connect(self)
+        if self.trace_timings is not None:
+            self.trace_timings['tls'] = time.time() - start - self.trace_timings['dns'] - self.trace_timings['connect']
+
+
+class TracingPoolMixin(object):
+    """Mixin of the urllib3 connection pools keeping the timings of the connection in every httplib response"""
+
+    def _make_request(self, conn, *args, **kwargs):
+        httplib_response = super(TracingPoolMixin, self)._make_request(conn, *args, **kwargs)
+        httplib_response.trace_timings = conn.pop_trace_timings()
+        return httplib_response
+
+
+class TracingHTTPConnectionPool(TracingPoolMixin, HTTPConnectionPool):
+    ConnectionCls = TracingHTTPConnection
+
+
+class TracingHTTPSConnectionPool(TracingPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = TracingHTTPSConnection
+
+
+# Connection pool classes to be used by the pool manager of a traced HTTPAdapter
+POOL_CLASSES = {'http': TracingHTTPConnectionPool, 'https': TracingHTTPSConnectionPool}
+
+
+class TracingAdapter(BaseAdapter):
+    """Transport adapter which keeps in resp.trace the timings of every response sent by another adapter.
+
+    The download time and the bytes received are set once the body is read.
+
+    """
+
+    def __init__(self, adapter):
+        BaseAdapter.__init__(self)
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        start = time.time()
+        resp = self.adapter.send(request, **kwargs)
+        headers_time = time.time() - start
+
+        original_response = getattr(resp.raw, '_original_response', None)
+        trace = dict(getattr(original_response, 'trace_timings', {}))
+        trace['ttfb'] = headers_time - sum(trace.get(phase, 0.0) for phase in ('dns', 'connect', 'tls'))
+        resp.trace = trace
+
+        # Bodies read already (e.g. by the HTTP cache) were downloaded within the time to first byte
+        if resp._content_consumed:
+            trace['download'] = 0.0
+            trace['bytes'] = 0 if getattr(resp, 'from_cache', False) else len(resp.content)
+            return resp
+
+        iter_content = resp.iter_content
+
+        def traced_iter_content(*args, **kwargs):
+            start = time.time()
+            size = 0
+            for chunk in iter_content(*args, **kwargs):
+                size += len(chunk)
+                yield chunk
+            trace['download'] = time.time() - start
+            trace['bytes'] = resp.raw.tell() if hasattr(resp.raw, 'tell') else size
+            on_done = trace.pop('on_done', None)
+            if on_done is not None:
+                on_done()
+        resp.iter_content = traced_iter_content
+
+        return resp
+
+    def close(self):
+        self.adapter.close()
+
+
+class Tracer(object):
+    """Collector of the request events, written to a json lines file and/or summarized by shop"""
+
+    def __init__(self, filename=None):
+        self.file = open(filename, 'w') if filename else None
+        self.queue = Queue.Queue()
+        # Totals by shop: requests, redirects, errors, bytes and seconds spent in every phase
+        self.totals = {}
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self._write_events)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, event):
+        """Record an event, without waiting for it to be written"""
+
+        self.queue.put_nowait(event)
+
+    def trace_response(self, shop_name, method, url, start, resp):
+        """Record the request sent at start which got resp (once its body is read)"""
+
+        hops = resp.history + [resp]
+
+        def emit():
+            event = {'time': start,
+                     'shop': shop_name,
+                     'method': method,
+                     'url': url,
+                     'status': resp.status_code,
+                     'redirects': len(resp.history),
+                     'from_cache': getattr(resp, 'from_cache', False),
+                     'elapsed': time.time() - start,
+                     'bytes': sum(getattr(hop, 'trace', {}).get('bytes', 0) for hop in hops)}
+            for phase in PHASES:
+                event[phase] = sum(getattr(hop, 'trace', {}).get(phase, 0.0) for hop in hops)
+            self.emit(event)
+
+        # Streamed responses are recorded once their body is read
+        trace = getattr(resp, 'trace', None)
+        if trace is not None and 'download' not in trace:
+            trace['on_done'] = emit
+        else:
+            emit()
+
+    def trace_error(self, shop_name, method, url, start, error):
+        """Record the request sent at start which failed with error"""
+
+        self.emit({'time': start,
+                   'shop': shop_name,
+                   'method': method,
+                   'url': url,
+                   'error': repr(error),
+                   'elapsed': time.time() - start})
+
+    def _write_events(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+
+            if self.file is not None:
+                self.file.write(json.dumps(event) + '\n')
+
+            with self._lock:
+                totals = self.totals.setdefault(event['shop'], dict.fromkeys(('requests', 'redirects', 'errors',
+                                                                              'bytes') + PHASES, 0))
+                totals['requests'] += 1
+                totals['redirects'] += event.get('redirects', 0)
+                totals['errors'] += 'error' in event
+                totals['bytes'] += event.get('bytes', 0)
+                for phase in PHASES:
+                    totals[phase] += event.get(phase, 0.0)
+
+    def close(self):
+        """Write the events still queued and stop"""
+
+        self.queue.put(None)
+        self.thread.join()
+        if self.file is not None:
+            self.file.close()
+
+    def format_summary(self):
+        """Return a table with the totals of every shop"""
+
+        lines = ['{0:<12} {1:>8} {2:>9} {3:>6} {4:>8} {5:>8} {6:>8} {7:>8} {8:>8} {9:>10}'.format(
+            'Shop', 'Requests', 'Redirects', 'Errors', 'DNS', 'Connect', 'TLS', 'TTFB', 'Download', 'Bytes')]
+        with self._lock:
+            for shop_name, totals in sorted(self.totals.items()):
+                lines.append('{0:<12} {requests:>8} {redirects:>9} {errors:>6} {dns:>7.3f}s {connect:>7.3f}s '
+                             '{tls:>7.3f}s {ttfb:>7.3f}s {download:>7.3f}s {bytes:>10}'.format(shop_name, **totals))
+        return '\n'.join(lines)